@@ -1,11 +1,23 @@
+import collections
 import datetime
+import fcntl
+import functools
+import hashlib
 import io
 import json
 import os
+import random
 import re
+import selectors
+import socket
+import string
 import subprocess
 import sys
+import threading
+import time
 from abc import *
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ContextDecorator
 from typing import Any, Callable, Iterable
 
@@ -47,8 +59,54 @@ class DaemonState:
 	STOPPING = "stopping"
 	INTERRUPTED = "interrupted"
 
+class DaemonEvent:
+	'''Events that are not state changes. Only the exec specs that explicitly
+	list these events are run.'''
+	DNS_SYNCED = "dns-synced"
+
 class MacroSet:
-	def __init__ (self):
+	'''
+	The values for the macros. See doc/macros.md
+
+	`overlay()` makes a view for a domain or a volume. The view stores only the
+	fields set on it. The rest are read from the parent as they are, by
+	reference. So don't modify the lists of the parent through a view. Assign
+	a new list to the view instead.
+	'''
+	__slots__ = (
+		"_parent",
+		"domain",
+		"instance_id",
+		"instance_type",
+		"instance_index",
+		"placement_region",
+		"placement_zone",
+		"hypervisor",
+		"primary_public_ipv4",
+		"primary_public_ipv6",
+		"public_ipv4_list",
+		"public_ipv6_list",
+		"static_dns_rr",
+		"attach_source",
+		"attach_op",
+		"volume_id",
+		"volume_pool",
+		"attached_device",
+		"daemon_state",
+		"error",
+		"interrupt_action",
+		"interrupt_time",
+		"dns_sync_time",
+		"exec_results",
+		"transaction_id",
+		"transaction_log",
+	)
+
+	def __init__ (self, parent: "MacroSet | None" = None):
+		self._parent = parent
+		if parent is not None:
+			return
+
 		self.domain: str = ""
 		self.instance_id: str = ""
 		self.instance_type: str = ""
@@ -70,14 +128,46 @@ class MacroSet:
 		self.error = list[str]()
 		self.interrupt_action = None
 		self.interrupt_time = None
+		self.dns_sync_time: float = None
+		self.exec_results = list[dict[str, Any]]()
 		self.transaction_id: str = None
 		self.transaction_log = list[ResourceTransactionLog]()
 
+	def __getattr__ (self, name: str):
+		# only called for the fields not set on the view
+		if name == "_parent" or name.startswith("__"):
+			raise AttributeError(name)
+
+		parent = self._parent
+		if parent is None:
+			raise AttributeError(name)
+		return getattr(parent, name)
+
+	def overlay (self) -> "MacroSet":
+		return MacroSet(self)
+
+	def exec_last (self) -> dict[str, Any] | None:
+		'''The last exec that failed or the last exec if none failed'''
+		for r in reversed(self.exec_results):
+			if not r["ok"]:
+				return r
+		return self.exec_results[-1] if self.exec_results else None
+
+	def macros (self, names: Iterable[str]) -> dict[str, Any]:
+		'''Render the macros in `names` only. Unknown names are left out'''
+		ret = dict[str, Any]()
+		for name in names:
+			f = MACRO_RENDERERS.get(name)
+			if f is not None:
+				ret[name] = f(self)
+		return ret
+
 	def dict (self, json_obj = False) -> dict[str, Any]:
 		if json_obj:
 			transc_f = lambda x: [ log.dict() for log in x ]
 		else:
 			transc_f = lambda x: x
+		exec_last = self.exec_last() or {}
 
 		return {
 			"domain": self.domain,
@@ -101,6 +191,10 @@ class MacroSet:
 			"error": self.error,
 			"interrupt_action": self.interrupt_action,
 			"interrupt_time": self.interrupt_time,
+			"dns_sync_time": self.dns_sync_time,
+			"exec_output": exec_last.get("output"),
+			"exec_runtime": exec_last.get("runtime"),
+			"exec_results": self.exec_results,
 			"transaction_id": self.transaction_id,
 			"transaction_log": transc_f(self.transaction_log),
 			"cwd": os.getcwd(),
@@ -108,43 +202,112 @@ class MacroSet:
 			"pid": os.getpid()
 		}
 
-	def format(self, s: str) -> str:
-		mask_none = lambda x: "" if x is None else str(x)
-		join_comma = lambda x: ", ".join(x if x is not None else [])
-		dump_json = lambda x: json.dumps(x, indent = '\t')
-
-		all_json = self.dict(True)
-
-		return s.format(
-			all_json = dump_json(all_json),
-
-			domain = all_json["domain"],
-			instance_id = all_json["instance_id"],
-			instance_type = all_json["instance_type"],
-			instance_index = mask_none(all_json["instance_index"]),
-			placement_region = mask_none(all_json["placement_region"]),
-			placement_zone = mask_none(all_json["placement_zone"]),
-			hypervisor = mask_none(all_json["hypervisor"]),
-			primary_public_ipv4 = mask_none(all_json["primary_public_ipv4"]),
-			primary_public_ipv6 = mask_none(all_json["primary_public_ipv6"]),
-			public_ipv4_list = join_comma(all_json["public_ipv4_list"]),
-			public_ipv6_list = join_comma(all_json["public_ipv6_list"]),
-			static_dns_rr = join_comma(all_json["static_dns_rr"]),
-			attach_source = mask_none(all_json["attach_source"]),
-			attach_op = mask_none(all_json["attach_op"]),
-			volume_id = mask_none(all_json["volume_id"]),
-			volume_pool = mask_none(all_json["volume_pool"]),
-			attached_device = mask_none(all_json["attached_device"]),
-			daemon_state = all_json["daemon_state"],
-			error = all_json["error"],
-			interrupt_action = mask_none(all_json["interrupt_action"]),
-			interrupt_time = mask_none(all_json["interrupt_time"]),
-			transaction_id = all_json["transaction_id"],
-			transaction_log = dump_json(all_json["transaction_log"]),
-			cwd = all_json["cwd"],
-			ts = all_json["ts"],
-			pid = all_json["pid"],
-		)
+	def format (self, s: str) -> str:
+		return compile_macro(s).render(self)
+
+def _mask_none (x) -> str:
+	return "" if x is None else str(x)
+
+def _join_comma (x) -> str:
+	return ", ".join(x if x is not None else [])
+
+def _dump_json (x) -> str:
+	return json.dumps(x, indent = '\t')
+
+def _exec_last (ms: MacroSet, key: str):
+	r = ms.exec_last()
+	return r.get(key) if r else None
+
+# how each macro is rendered. See doc/macros.md
+MACRO_RENDERERS: dict[str, Callable[[MacroSet], Any]] = {
+	"all_json": lambda ms: _dump_json(ms.dict(True)),
+
+	"domain": lambda ms: ms.domain,
+	"instance_id": lambda ms: ms.instance_id,
+	"instance_type": lambda ms: ms.instance_type,
+	"instance_index": lambda ms: _mask_none(ms.instance_index),
+	"placement_region": lambda ms: _mask_none(ms.placement_region),
+	"placement_zone": lambda ms: _mask_none(ms.placement_zone),
+	"hypervisor": lambda ms: _mask_none(ms.hypervisor),
+	"primary_public_ipv4": lambda ms: _mask_none(ms.primary_public_ipv4),
+	"primary_public_ipv6": lambda ms: _mask_none(ms.primary_public_ipv6),
+	"public_ipv4_list": lambda ms: _join_comma(ms.public_ipv4_list),
+	"public_ipv6_list": lambda ms: _join_comma(ms.public_ipv6_list),
+	"static_dns_rr": lambda ms: _join_comma(ms.static_dns_rr),
+	"attach_source": lambda ms: _mask_none(ms.attach_source),
+	"attach_op": lambda ms: _mask_none(ms.attach_op),
+	"volume_id": lambda ms: _mask_none(ms.volume_id),
+	"volume_pool": lambda ms: _mask_none(ms.volume_pool),
+	"attached_device": lambda ms: _mask_none(ms.attached_device),
+	"daemon_state": lambda ms: ms.daemon_state,
+	"error": lambda ms: ms.error,
+	"interrupt_action": lambda ms: _mask_none(ms.interrupt_action),
+	"interrupt_time": lambda ms: _mask_none(ms.interrupt_time),
+	"dns_sync_time": lambda ms: _mask_none(ms.dns_sync_time),
+	"exec_output": lambda ms: _mask_none(_exec_last(ms, "output")),
+	"exec_runtime": lambda ms: _mask_none(_exec_last(ms, "runtime")),
+	"exec_results": lambda ms: _dump_json(ms.exec_results),
+	"transaction_id": lambda ms: ms.transaction_id,
+	"transaction_log": lambda ms: _dump_json(
+		[ log.dict() for log in ms.transaction_log ]),
+	"cwd": lambda ms: os.getcwd(),
+	"ts": lambda ms: datetime.datetime.now().astimezone().isoformat(),
+	"pid": lambda ms: os.getpid(),
+}
+
+class MacroTemplate:
+	'''A format string parsed once. Only the macros referenced in the string
+	are rendered, each once per `render()`.'''
+
+	def __init__ (self, s: str):
+		self.s = s
+		self.names = set[str]()
+
+		for _, field, _, _ in string.Formatter().parse(s):
+			if field is None:
+				continue
+			# "{a.b}" and "{a[0]}" refer to "a"
+			self.names.add(re.split('''[.\\[]''', field, maxsplit = 1)[0])
+
+		# nothing to substitute. Only the escapes("{{", "}}")
+		self._literal = None if self.names else s.format()
+
+	def render (self, ms: MacroSet) -> str:
+		if self._literal is not None:
+			return self._literal
+		return self.s.format(**ms.macros(self.names))
+
+@functools.lru_cache(maxsize = 1024)
+def compile_macro (s: str) -> MacroTemplate:
+	return MacroTemplate(s)
+
+def referenced_macros (doc: Any) -> set[str]:
+	'''The macros referenced in the strings in `doc`(the config)'''
+	ret = set[str]()
+
+	if isinstance(doc, str):
+		try:
+			ret |= compile_macro(doc).names
+		except ValueError:
+			# not a format string. Fails when it's used anyway
+			pass
+	elif isinstance(doc, dict):
+		for v in doc.values():
+			ret |= referenced_macros(v)
+	elif isinstance(doc, list):
+		for v in doc:
+			ret |= referenced_macros(v)
+
+	return ret
+
+def hrw_rank (key: str, ids: Iterable[str]) -> list[str]:
+	'''Rendezvous(highest random weight) hashing. Orders `ids` by the weight
+	of each id for `key`. Different keys get different orders so that the
+	callers with different keys mostly pick different ids first.'''
+	def weight (id: str) -> bytes:
+		return hashlib.sha256((key + '\0' + id).encode()).digest()
+
+	return sorted(ids, key = weight, reverse = True)
 
 class ResourceTransactionLog (ABC):
 	'''Represents a resource transaction that's been done (by
@@ -164,24 +327,44 @@ class ResourceHold (ABC):
 	@abstractmethod
 	def commit (self): ...
 
+	def state (self) -> dict[str, Any] | None:
+		'''What's needed to roll back the hold in another process. Written to
+		the journal. None if the hold cannot be restored that way.'''
+		return None
+
 class ResourceTransactionLogger:
-	def __init__ (self):
-		self.logs = list[ResourceTransactionLog]()
+	'''Only the last `cap` logs are kept in memory. The subscribers in
+	`cbset`(the journal) get all of them.'''
+	def __init__ (self, cap: int | None = magic.Code.TRANSC_LOG_CAP):
+		self.logs = collections.deque[ResourceTransactionLog](maxlen = cap)
 		self.cbset = set[Callable[[Iterable[ResourceTransactionLog]], Any]]()
+		self._lock = threading.Lock()
 
 	def publish (self, logs: Iterable[ResourceTransactionLog]):
-		self.logs += logs
-		for cb in self.cbset:
-			cb(logs)
+		with self._lock:
+			self.logs += logs
+			for cb in self.cbset:
+				cb(logs)
+
+def cap_transc_log (
+		logs: list[ResourceTransactionLog],
+		cap: int = magic.Code.TRANSC_LOG_CAP) -> list[ResourceTransactionLog]:
+	return logs[-cap:]
 
 class TransientResourceManager (ContextDecorator):
 	def __init__ (
 			self,
 			critical: bool,
-			parent = None):
+			parent = None,
+			journal = None):
 		self._hold = list[ResourceHold]()
 		self._critical = critical
 		self._parent = parent
+		if journal is None and parent is not None:
+			journal = parent._journal
+		self._journal: TransactionJournal | None = journal
+		# children in different threads may move to the parent at the same time
+		self._lock = threading.Lock()
 
 	def __enter__ (self):
 		return self
@@ -210,18 +393,26 @@ class TransientResourceManager (ContextDecorator):
 		return False
 
 	def move (self, other):
-		other._hold += self._hold
-		self._hold.clear()
+		with self._lock:
+			other._push(self._hold)
+			self._hold.clear()
 
-	def push (self, rt: ResourceHold):
-		self._hold.append(rt)
+	def _push (self, rt: Iterable[ResourceHold]):
+		with self._lock:
+			self._hold += rt
 
 	def push (self, rt: Iterable[ResourceHold]):
-		self._hold += rt
+		rt = list(rt)
+		if self._journal:
+			for h in rt:
+				self._journal.hold(h)
+		self._push(rt)
 
 	def commit (self):
 		for rt in self._hold:
 			rt.commit()
+			if self._journal:
+				self._journal.settle(rt, "commit")
 
 		self._hold.clear()
 
@@ -232,9 +423,415 @@ class TransientResourceManager (ContextDecorator):
 				rt.rollback()
 			except:
 				pass
+			else:
+				if self._journal:
+					self._journal.settle(rt, "rollback")
 
 		self._hold.clear()
 
+class TransactionJournal:
+	'''
+	Append-only JSON lines of a transaction: the logs and the holds along with
+	their commit/rollback. Kept on disk so that the holds left unsettled by a
+	process that's been killed can be rolled back by the next one.
+
+	The file is locked for the life of the object so that the journals of the
+	other instances running at the same time are left alone. BlockingIOError
+	is raised if the file is locked.
+
+	The records are synced in groups by a thread every `sync_interval`. Only
+	the hold records are waited on before returning.
+	'''
+
+	FILENAME = "journal"
+
+	def __init__ (
+			self,
+			path: str,
+			meta: dict[str, Any] = {},
+			sync_interval: float = magic.Code.JOURNAL_SYNC_INTERVAL):
+		self.path = path
+		# the first record
+		self.meta = dict[str, Any]()
+		# the holds not settled, in the order they were held
+		self.pending = dict[int, dict[str, Any]]()
+		self._held = dict[int, int]() # id(hold) -> seq
+		self._seq = 0
+		self._written = 0
+		self._synced = 0
+		self._waiters = 0
+		self._closed = False
+		self._cond = threading.Condition()
+		self._sync_interval = sync_interval
+
+		os.makedirs(os.path.dirname(path), mode = 0o700, exist_ok = True)
+		self._f = open(path, "a+b")
+		try:
+			fcntl.flock(self._f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			self._f.seek(0)
+			self._load(self._f)
+		except:
+			self._f.close()
+			raise
+
+		if not self.meta:
+			self.meta = dict(meta)
+			self._append({ "rec": "begin", **self.meta })
+
+		self._th = threading.Thread(target = self._sync_main, daemon = True)
+		self._th.start()
+
+	@staticmethod
+	def mk_path (state_dir: str, transc_id: str) -> str:
+		return os.path.join(state_dir, transc_id, TransactionJournal.FILENAME)
+
+	@staticmethod
+	def find (state_dir: str) -> list[str]:
+		'''The paths of the journals in `state_dir`'''
+		try:
+			ents = os.listdir(state_dir)
+		except FileNotFoundError:
+			return []
+
+		ret = list[str]()
+		for ent in ents:
+			path = os.path.join(state_dir, ent, TransactionJournal.FILENAME)
+			if os.path.isfile(path):
+				ret.append(path)
+
+		return ret
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *exc):
+		self.close()
+		return False
+
+	def _load (self, f: io.BufferedIOBase):
+		while True:
+			pos = f.tell()
+			line = f.readline()
+			if not line:
+				break
+			try:
+				if not line.endswith(b'\n'):
+					raise ValueError()
+				rec = json.loads(line)
+			except ValueError:
+				# torn write of the last record
+				f.truncate(pos)
+				break
+
+			match rec.get("rec"):
+				case "begin":
+					self.meta = { k: v for k, v in rec.items() if k != "rec" }
+				case "hold":
+					self._seq = max(self._seq, rec["seq"])
+					self.pending[rec["seq"]] = rec["state"]
+				case "commit" | "rollback":
+					self.pending.pop(rec["seq"], None)
+
+	def _append (self, rec: dict[str, Any]) -> int:
+		line = json.dumps(rec, default = str).encode() + b'\n'
+		with self._cond:
+			if self._closed:
+				# the record would be lost. The replay would then undo what's
+				# been committed.
+				raise ValueError(self.path + ": journal closed")
+			self._f.write(line)
+			self._written += 1
+			self._cond.notify_all()
+
+			return self._written
+
+	def _wait_synced (self, n: int):
+		with self._cond:
+			self._waiters += 1
+			self._cond.notify_all()
+			try:
+				while self._synced < n and not self._closed:
+					self._cond.wait()
+			finally:
+				self._waiters -= 1
+
+	def _sync_main (self):
+		while True:
+			with self._cond:
+				while self._synced == self._written and not self._closed:
+					self._cond.wait()
+				if self._closed:
+					return
+				n = self._written
+				self._f.flush()
+
+			# the records appended in the meantime go in the next group
+			os.fsync(self._f.fileno())
+			with self._cond:
+				self._synced = n
+				self._cond.notify_all()
+
+				# gather the logs for the next group unless someone's waiting
+				end = time.monotonic() + self._sync_interval
+				while not self._waiters and not self._closed:
+					t = end - time.monotonic()
+					if t <= 0:
+						break
+					self._cond.wait(t)
+
+	def log (self, logs: Iterable[ResourceTransactionLog]):
+		'''For `ResourceTransactionLogger.cbset`'''
+		for log in logs:
+			self._append({ "rec": "log", "log": log.dict() })
+
+	def hold (self, rt: ResourceHold):
+		state = rt.state()
+		if state is None:
+			return
+
+		with self._cond:
+			self._seq += 1
+			seq = self._seq
+			self._held[id(rt)] = seq
+			self.pending[seq] = state
+		# the resource must not be forgotten once the caller moves on
+		self._wait_synced(self._append({
+			"rec": "hold",
+			"seq": seq,
+			"state": state }))
+
+	def adopt (self, rt: ResourceHold, seq: int):
+		'''Take over a pending hold loaded from the file'''
+		with self._cond:
+			self._held[id(rt)] = seq
+
+	def settle (self, rt: ResourceHold, how: str):
+		with self._cond:
+			seq = self._held.pop(id(rt), None)
+			if seq is None:
+				return
+			self.pending.pop(seq, None)
+		self._append({ "rec": how, "seq": seq })
+
+	def discard (self):
+		'''Forget the pending holds so that the file is removed upon close'''
+		with self._cond:
+			self._held.clear()
+			self.pending.clear()
+
+	def close (self):
+		'''The file is removed if all the holds are settled'''
+		with self._cond:
+			if self._closed:
+				return
+			self._closed = True
+			self._cond.notify_all()
+		self._th.join()
+
+		try:
+			self._f.flush()
+			if self.pending:
+				os.fsync(self._f.fileno())
+			else:
+				os.unlink(self.path)
+				try:
+					os.rmdir(os.path.dirname(self.path))
+				except OSError:
+					pass
+		finally:
+			self._f.close()
+
+class Deadline:
+	'''A point in time by which the work has to be done. Passed down to the
+	functions that wait so that the waits are cut short and TimeoutError is
+	raised once the deadline is passed or the deadline is cancelled.'''
+
+	def __init__ (self, timeout: float | None = None):
+		if timeout is None:
+			self._end = None
+		else:
+			self._end = time.monotonic() + timeout
+		self._cancelled = threading.Event()
+
+	def cancel (self):
+		'''Expire the deadline now, waking up everyone sleeping on it'''
+		self._cancelled.set()
+
+	def remaining (self) -> float | None:
+		'''Seconds left. None if unbounded'''
+		if self._cancelled.is_set():
+			return 0.0
+		if self._end is None:
+			return None
+		return max(0.0, self._end - time.monotonic())
+
+	def expired (self) -> bool:
+		return self.remaining() == 0.0
+
+	def check (self):
+		if self.expired():
+			raise TimeoutError("deadline exceeded")
+
+	def clamp (self, timeout: float | None) -> float | None:
+		'''The smaller of `timeout` and the remaining time'''
+		r = self.remaining()
+		if timeout is None:
+			return r
+		if r is None:
+			return timeout
+		return min(timeout, r)
+
+	def sleep (self, secs: float):
+		'''Sleep, or raise TimeoutError if the deadline comes first'''
+		r = self.remaining()
+		if r is not None and r < secs:
+			self._cancelled.wait(r)
+			raise TimeoutError("deadline exceeded")
+
+		if self._cancelled.wait(secs):
+			raise TimeoutError("deadline cancelled")
+
+class TokenBucket:
+	'''Token bucket rate limiter. `rate` tokens are added per second up to
+	`burst`. `throttle()` cuts the rate and holds off everyone for a while.
+	The rate is regained gradually with `relax()`.'''
+
+	def __init__ (
+			self,
+			rate: float,
+			burst: float,
+			min_rate: float = magic.Code.RATE_MIN,
+			recovery: float = magic.Code.RATE_RECOVERY):
+		self.rate = rate
+		self.burst = burst
+		self._min_rate = rate * min_rate
+		self._recovery = rate * recovery
+		self._cur_rate = rate
+		self._tokens = float(burst)
+		self._last = time.monotonic()
+		self._hold = 0.0
+		self._lock = threading.Lock()
+
+	@property
+	def cur_rate (self) -> float:
+		return self._cur_rate
+
+	def _refill (self, now: float):
+		self._tokens = min(
+			self.burst,
+			self._tokens + (now - self._last) * self._cur_rate)
+		self._last = now
+
+	def acquire (self, deadline: Deadline | None = None):
+		'''Take a token, waiting for one if necessary. TimeoutError is raised
+		if the `deadline` comes before the token does.'''
+		while True:
+			with self._lock:
+				now = time.monotonic()
+				self._refill(now)
+				if now >= self._hold and self._tokens >= 1:
+					self._tokens -= 1
+					return
+
+				wait = max(
+					self._hold - now,
+					(1 - self._tokens) / self._cur_rate)
+
+			if deadline is None:
+				time.sleep(wait)
+			elif deadline.clamp(wait) < wait:
+				raise TimeoutError("deadline exceeded")
+			else:
+				deadline.sleep(wait)
+
+	def throttle (self, backoff: float):
+		'''Halve the rate and give out no tokens for `backoff` seconds'''
+		with self._lock:
+			now = time.monotonic()
+			self._refill(now)
+			self._cur_rate = max(self._min_rate, self._cur_rate / 2)
+			self._tokens = 0.0
+			self._hold = max(self._hold, now + backoff)
+
+	def relax (self):
+		with self._lock:
+			if self._cur_rate < self.rate:
+				self._refill(time.monotonic())
+				self._cur_rate = min(self.rate, self._cur_rate + self._recovery)
+
+class DAGTask:
+	'''A unit of work for `run_dag()`. The task is run after all the tasks
+	in `after` are done.'''
+	def __init__ (
+			self,
+			id: str,
+			f: Callable[[], Any],
+			after: Iterable[str] | None = None):
+		self.id = id
+		self.f = f
+		self.after = set[str](after or [])
+
+def run_dag (
+		tasks: Iterable[DAGTask],
+		max_workers: int | None = None) -> dict[str, Any]:
+	'''Run the tasks concurrently, respecting the dependencies between them.
+	The tasks are started in the order of appearance when there are more
+	runnable tasks than workers.
+
+	Fail-fast: no more task is started once a task raises an exception. The
+	exception is raised again after the tasks already running are finished.'''
+	pending = dict[str, DAGTask]()
+	for t in tasks:
+		if t.id in pending:
+			raise ValueError(t.id + ": duplicate id")
+		pending[t.id] = t
+	for t in pending.values():
+		for dep in t.after:
+			if dep not in pending:
+				raise ValueError(
+					'''{id}: unknown dependency "{dep}"'''.format(
+						id = t.id,
+						dep = dep))
+
+	done = dict[str, Any]()
+	running = dict[futures.Future, DAGTask]()
+	exc = None
+
+	if max_workers is None or max_workers <= 0:
+		max_workers = max(1, len(pending))
+
+	with ThreadPoolExecutor(max_workers) as pool:
+		while pending or running:
+			if exc is None:
+				for t in list(pending.values()):
+					if len(running) >= max_workers:
+						break
+					if t.after.issubset(done.keys()):
+						del pending[t.id]
+						running[pool.submit(t.f)] = t
+
+			if not running:
+				if pending and exc is None:
+					raise ValueError(
+						", ".join(pending.keys()) + ": circular dependency")
+				break
+
+			fin, _ = futures.wait(
+				running.keys(),
+				return_when = futures.FIRST_COMPLETED)
+			for f in fin:
+				t = running.pop(f)
+				e = f.exception()
+				if e is None:
+					done[t.id] = f.result()
+				elif exc is None:
+					exc = e
+
+	if exc is not None:
+		raise exc
+
+	return done
+
 class ExitCodeCheck:
 	class RE:
 		RANGE = re.compile('''^(\\d+)(?:\\s+)?(?:-(?:\\s+)?(\\d+))?$''')
@@ -280,16 +877,180 @@ class ExitCodeCheck:
 
 		return False
 
+class RingBuffer:
+	'''Keeps the last `size` bytes written'''
+
+	def __init__ (self, size: int):
+		self.size = size
+		self.total = 0
+		self._buf = bytearray()
+		self._lock = threading.Lock()
+
+	def write (self, b: bytes):
+		with self._lock:
+			self.total += len(b)
+			self._buf += b[-self.size:]
+			excess = len(self._buf) - self.size
+			if excess > 0:
+				del self._buf[:excess]
+
+	def getvalue (self) -> bytes:
+		with self._lock:
+			return bytes(self._buf)
+
+def pump_output (
+		pipes: Iterable[tuple[io.BufferedIOBase, io.TextIOBase]],
+		ring: RingBuffer):
+	'''Copy the output of the child to `ring` and the destination streams as
+	it comes. The pipes are closed on EOF.'''
+	sel = selectors.DefaultSelector()
+	for src, dst in pipes:
+		os.set_blocking(src.fileno(), False)
+		sel.register(src, selectors.EVENT_READ, dst)
+
+	try:
+		while sel.get_map():
+			for key, _ in sel.select():
+				try:
+					b = os.read(key.fd, 65536)
+				except BlockingIOError:
+					continue
+
+				if not b:
+					sel.unregister(key.fileobj)
+					key.fileobj.close()
+					continue
+
+				ring.write(b)
+				try:
+					key.data.buffer.write(b)
+					key.data.buffer.flush()
+				except (AttributeError, OSError, ValueError):
+					pass # the log is best effort
+	finally:
+		sel.close()
+
+class ExecResult:
+	def __init__ (
+			self,
+			cmd: str,
+			pid: int,
+			ec: int | None,
+			runtime: float,
+			ok: bool,
+			ring: RingBuffer | None = None,
+			skipped: bool = False):
+		self.cmd = cmd
+		self.pid = pid
+		self.ec = ec
+		self.runtime = runtime
+		self.ok = ok
+		self.skipped = skipped
+		if ring is None:
+			self.output = None
+			self.truncated = False
+		else:
+			self.output = ring.getvalue().decode(errors = "replace")
+			self.truncated = ring.total > ring.size
+
+	def dict (self) -> dict[str, Any]:
+		return {
+			"cmd": self.cmd,
+			"pid": self.pid,
+			"ec": self.ec,
+			"runtime": round(self.runtime * 1000), # in ms
+			"ok": self.ok,
+			"skipped": self.skipped,
+			"output": self.output,
+			"truncated": self.truncated
+		}
+
 class Exec:
-	def __init__ (self, argv: Iterable[str], eccs: str | None = None):
+	def __init__ (
+			self,
+			argv: Iterable[str],
+			eccs: str | None = None,
+			capture: int = 0,
+			priority: int = 0,
+			max_duration: float | None = None):
+		'''`capture`: the number of bytes of the output to keep. 0 to let the
+		child inherit stdout and stderr. See `ExecBudget` for `priority` and
+		`max_duration`.'''
 		self._argv = list[str](argv)
 		self._ecc = ExitCodeCheck(eccs)
+		self._capture = capture
+		self.priority = priority
+		self.max_duration = max_duration
+		self.result: ExecResult | None = None
+
+	def do_exec (self, timeout: float | None = None) -> int:
+		ring = None
+		kwargs = dict[str, Any]()
+		if self._capture:
+			ring = RingBuffer(self._capture)
+			kwargs["stdout"] = subprocess.PIPE
+			kwargs["stderr"] = subprocess.PIPE
+
+		t0 = time.monotonic()
+		with subprocess.Popen(self._argv, **kwargs) as p:
+			if ring:
+				# the pipes are the pump's to close
+				pump = threading.Thread(
+					target = pump_output,
+					args = (
+						[ ( p.stdout, sys.stdout ), ( p.stderr, sys.stderr ) ],
+						ring),
+					daemon = True)
+				p.stdout = p.stderr = None
+				pump.start()
+
+			try:
+				ret = p.wait(timeout)
+			except subprocess.TimeoutExpired:
+				p.kill()
+				p.wait()
+				ret = None
 
-	def do_exec (self) -> int:
-		with subprocess.Popen(self._argv) as p:
-			ret = p.wait()
-			self.raise_exitcode(ret)
-			return ret
+			if ring:
+				pump.join(magic.Code.EXEC_DRAIN_TIMEOUT)
+			self.result = ExecResult(
+				self.cmd_str(),
+				p.pid,
+				ret,
+				time.monotonic() - t0,
+				ret is not None and self.check_exitcode(ret),
+				ring)
+
+			if ret is None:
+				e = TimeoutError(
+					'''{cmd}[{pid}]: killed after {t:.3f}s'''.format(
+						cmd = self.cmd_str(),
+						pid = p.pid,
+						t = timeout))
+			elif not self.result.ok:
+				e = self.mk_exitcode_error(ret, p.pid)
+			else:
+				return ret
+
+			if self.result.output:
+				e.add_note(self.result.output)
+			raise e
+
+	def skip (self):
+		self.result = ExecResult(
+			self.cmd_str(),
+			None,
+			None,
+			0.0,
+			False,
+			skipped = True)
+		sys.stderr.write(
+			'''{cmd}: skipped, out of time{nl}'''.format(
+				cmd = self.cmd_str(),
+				nl = os.linesep))
+
+	def cmd_str (self) -> str:
+		return ' '.join([ '"{arg}"'.format(arg = arg) for arg in self._argv ])
 
 	def check_exitcode (self, ec: int) -> bool:
 		return self._ecc.check(ec)
@@ -297,60 +1058,342 @@ class Exec:
 	def raise_exitcode (self, ec: int, pid = None):
 		if self.check_exitcode(ec):
 			return
-		cmd = ' '.join([ '"{arg}"'.format(arg = arg) for arg in self._argv ])
+		raise self.mk_exitcode_error(ec, pid)
+
+	def mk_exitcode_error (self, ec: int, pid = None) -> ChildProcessError:
+		cmd = self.cmd_str()
 		if pid is None:
 			pid = ""
 
-		raise ChildProcessError(
+		return ChildProcessError(
 '''{cmd}[{pid}]: returned {ec}, not in {range}'''.format(
 					cmd = cmd,
 					pid = pid,
 					ec = ec,
 					range = self._ecc))
 
+class ExecBudget:
+	'''
+	Hands out the time left until the deadline to the exec lines. Before a line
+	is started, the "max-duration" of the lines of higher priority yet to run
+	is set aside. The line gets what's left, but no more than its own
+	"max-duration". The line is skipped if nothing is left.
+
+	In `lenient` mode(used on interruption), a line killed for running out of
+	its time does not stop the rest. The lines after it may still make it.
+	'''
+
+	def __init__ (
+			self,
+			deadline: Deadline,
+			lines: Iterable[Exec],
+			lenient: bool = False):
+		self.deadline = deadline
+		self.lenient = lenient
+		self._pending = list[Exec](lines)
+		self._lock = threading.Lock()
+
+	def start (self, exec: Exec) -> float | None:
+		'''The time given to the line. 0 if the line is to be skipped, None if
+		unbounded'''
+		with self._lock:
+			if exec in self._pending:
+				self._pending.remove(exec)
+			reserve = sum(
+				e.max_duration or 0
+				for e in self._pending
+				if e.priority > exec.priority)
+
+		remaining = self.deadline.remaining()
+		if remaining is None:
+			return exec.max_duration
+
+		left = remaining - reserve
+		if left <= 0:
+			return 0
+		if exec.max_duration is None:
+			return left
+		return min(left, exec.max_duration)
+
+class ExecGroup:
+	'''The lines of an exec spec. The lines are run one after another in the
+	order of appearance. With "concurrency" or "after", the lines are run as a
+	DAG(see `run_dag()`) instead.'''
+
+	def __init__ (self, concurrency: int = 1):
+		self.concurrency = concurrency
+		self.lines = list[tuple[str, Exec, set[str]]]()
+
+	def add (self, id: str, exec: Exec, after: Iterable[str] | None = None):
+		self.lines.append(( id, exec, set[str](after or []) ))
+
+	def run (
+			self,
+			budget: ExecBudget,
+			results: list[ExecResult] | None = None):
+		def f (exec: Exec):
+			budget.deadline.check()
+
+			timeout = budget.start(exec)
+			try:
+				if timeout == 0:
+					exec.skip()
+				else:
+					exec.do_exec(timeout)
+			except TimeoutError as e:
+				if not budget.lenient or budget.deadline.expired():
+					raise
+				pexcept(e)
+			finally:
+				if results is not None and exec.result:
+					results.append(exec.result)
+
+		if self.concurrency == 1 and not any(l[2] for l in self.lines):
+			for _, exec, _ in self.lines:
+				f(exec)
+			return
+
+		run_dag(
+			[
+				DAGTask(id, lambda exec = exec: f(exec), after)
+				for id, exec, after in self.lines
+			],
+			self.concurrency)
+
 def init_exec_mat (
 		it: Iterable[dict],
 		trans_f: Callable[[str], str]) -> tuple[
-			list[Exec],
-			dict[str, list[Exec]]]:
-	m = dict[str, list[Exec]]()
-	all = list[Exec]()
+			list[ExecGroup],
+			dict[str, list[ExecGroup]]]:
+	m = dict[str, list[ExecGroup]]()
+	all = list[ExecGroup]()
 
 	for spec in it:
-		l_ec = list[Exec]()
+		group = ExecGroup(spec.get("concurrency", 1))
 
-		for line in spec["lines"]:
+		for i, line in enumerate(spec["lines"]):
 			argv = [ trans_f(arg) for arg in line["argv"] ]
-			ec = Exec(argv, line.get("ec", "0"))
-			l_ec.append(ec)
+			capture = line.get("capture", spec.get("capture", False))
+			if capture is True:
+				capture = magic.Code.EXEC_CAPTURE_SIZE
+			ec = Exec(
+				argv,
+				line.get("ec", spec.get("ec", "0")),
+				int(capture or 0),
+				line.get("priority", spec.get("priority", 0)),
+				line.get("max-duration", spec.get("max-duration")))
+			group.add(
+				line.get("id", '''lines[{i}]'''.format(i = i)),
+				ec,
+				line.get("after"))
 
 		l_event = spec.get("on")
 		if l_event is None:
-			all += l_ec
+			all.append(group)
 		else:
 			for on in l_event:
-				if on in m:
-					m[on] += l_ec
-				else:
-					m[on] = l_ec
+				m.setdefault(on, []).append(group)
 
 	return ( all, m )
 
 def do_exec_mat (
-		mat: tuple[list[Exec], dict[str, list[Exec]]],
-		evt: str | None = None):
-	l = list[Exec](mat[0])
+		mat: tuple[list[ExecGroup], dict[str, list[ExecGroup]]],
+		evt: str | None = None,
+		wildcard: bool = True,
+		deadline: Deadline | None = None,
+		results: list[ExecResult] | None = None,
+		lenient: bool = False):
+	if wildcard:
+		l = list[ExecGroup](mat[0])
+	else:
+		l = list[ExecGroup]()
 
 	if evt is not None:
 		l += mat[1].get(evt, [])
 
-	for exec in l:
-		exec.do_exec()
+	if deadline is None:
+		deadline = Deadline()
+	budget = ExecBudget(
+		deadline,
+		[ exec for group in l for _, exec, _ in group.lines ],
+		lenient)
+
+	for group in l:
+		deadline.check()
+		group.run(budget, results)
+
+class NotifyFailedError (Exception):
+	'''A message the backend did not take. `retryable` if sending the same
+	message again may succeed.'''
+	def __init__ (self, msg: str, retryable: bool = False):
+		super().__init__(msg)
+		self.retryable = retryable
 
 class NotifyBackend (ABC):
+	# the most messages `post_batch()` takes in one call
+	max_batch = 1
+
 	@abstractmethod
 	def post (self, subject: str, body: str): ...
 
+	def target (self) -> Any:
+		'''Where the messages go. The same message is sent once per target.'''
+		return self
+
+	def post_batch (
+			self,
+			msgs: list[tuple[str, str]]) -> list[Exception | None]:
+		'''Send the (subject, body) pairs. The exception for each message that
+		failed, None for the ones sent.'''
+		ret = list[Exception | None]()
+		for subject, body in msgs:
+			try:
+				self.post(subject, body)
+				ret.append(None)
+			except Exception as e:
+				ret.append(e)
+
+		return ret
+
+class NotifyDispatcher:
+	'''
+	Sends the notifications in the background.
+
+	The messages are deduplicated per target against the ones not sent yet.
+	Only the identical subjects and bodies are, so the messages that render
+	per-domain values like the default envelope does are all sent. With the
+	default envelope, nothing is coalesced.
+
+	The messages to the same target are handed to the backend in batches of
+	`NotifyBackend.max_batch` and the batches are sent concurrently. The
+	messages rejected as retryable are sent again with backoff.
+
+	At most `max_pending` messages are held. The ones that don't fit and the
+	ones dispatched after `shutdown()` are dropped and reported to `on_error`.
+	'''
+	def __init__ (
+			self,
+			on_error: Callable[[Exception], None] | None = None,
+			max_workers: int = magic.Code.NOTIFY_CONCURRENCY,
+			max_pending: int = magic.Code.NOTIFY_MAX_PENDING,
+			retry_max: int = magic.Code.NOTIFY_RETRY_MAX):
+		self.on_error = on_error
+		self.max_pending = max_pending
+		self.retry_max = retry_max
+		self.sent = 0
+		self.deduped = 0
+		self.dropped = 0
+		self.failed = 0
+		self._executor = ThreadPoolExecutor(
+			max_workers,
+			thread_name_prefix = "notify")
+		self._cond = threading.Condition()
+		self._pending = set[tuple[Any, str, str]]()
+		self._closed = False
+
+	def _error (self, e: Exception):
+		if self.on_error:
+			self.on_error(e)
+
+	def dispatch (self, msgs: Iterable[tuple[NotifyBackend, str, str]]):
+		'''Queue the (backend, subject, body) messages and return without
+		waiting for them to be sent.'''
+		groups = dict[Any, tuple[NotifyBackend, list[tuple[str, str]]]]()
+		dropped = 0
+		closed = 0
+
+		with self._cond:
+			for backend, subject, body in msgs:
+				if self._closed:
+					# a late callback like dns-synced
+					closed += 1
+					continue
+				target = backend.target()
+				key = ( target, subject, body )
+				if key in self._pending:
+					self.deduped += 1
+					continue
+				if len(self._pending) >= self.max_pending:
+					dropped += 1
+					continue
+
+				self._pending.add(key)
+				groups.setdefault(target, ( backend, [] ))[1].append(
+					( subject, body ))
+			self.dropped += dropped + closed
+
+			# under the lock so that shutdown() can't come in between
+			for target, ( backend, l ) in groups.items():
+				n = max(1, backend.max_batch)
+				for i in range(0, len(l), n):
+					self._executor.submit(
+						self._send,
+						backend,
+						target,
+						l[i:i + n])
+
+		if dropped:
+			self._error(NotifyFailedError(
+				'''{n} message(s) dropped: {max} pending already'''.format(
+					n = dropped,
+					max = self.max_pending)))
+		if closed:
+			self._error(NotifyFailedError(
+				'''{n} message(s) dropped: dispatcher shut down'''.format(
+					n = closed)))
+
+	def _send (
+			self,
+			backend: NotifyBackend,
+			target: Any,
+			batch: list[tuple[str, str]]):
+		attempt = 0
+
+		while batch:
+			try:
+				results = backend.post_batch(batch)
+			except Exception as e:
+				results = [ e ] * len(batch)
+
+			retry = list[tuple[str, str]]()
+			done = list[tuple[Any, str, str]]()
+			errors = list[Exception]()
+			for msg, e in zip(batch, results):
+				if (isinstance(e, NotifyFailedError) and e.retryable and
+						attempt < self.retry_max):
+					retry.append(msg)
+					continue
+
+				done.append(( target, *msg ))
+				if e is not None:
+					errors.append(e)
+
+			for e in errors:
+				self._error(e)
+			with self._cond:
+				self.sent += len(done) - len(errors)
+				self.failed += len(errors)
+				self._pending.difference_update(done)
+				self._cond.notify_all()
+
+			if retry:
+				attempt += 1
+				time.sleep(random.uniform(0, min(
+					magic.Code.NOTIFY_RETRY_CAP,
+					magic.Code.NOTIFY_RETRY_BASE * 2 ** attempt)))
+			batch = retry
+
+	def wait (self, timeout: float | None = None) -> bool:
+		'''Wait for the messages queued so far. False on timeout.'''
+		with self._cond:
+			return self._cond.wait_for(lambda: not self._pending, timeout)
+
+	def shutdown (self):
+		'''Stop sending. The messages not sent yet are discarded.'''
+		with self._cond:
+			self._closed = True
+			self._executor.shutdown(wait = False, cancel_futures = True)
+
 class InterruptSchedule (ABC):
 	@abstractmethod
 	def __bool__ (self) -> bool: ...
@@ -366,8 +1409,427 @@ class MetaManager (ABC):
 	def update_macroset (meta: Any, ms: MacroSet): ...
 
 	@abstractmethod
-	def fetch_meta (self): ...
+	def fetch_meta (self, ms: MacroSet, fields: Iterable[str] | None = None): ...
+	@abstractmethod
+	def verify_meta (self, ms: MacroSet) -> bool:
+		'''Check the meta data restored from `StateCache` with a few requests
+		rather than the whole crawl'''
 	@abstractmethod
-	def open_userdata (self) -> io.BufferedIOBase: ...
+	def meta_fields (self) -> Iterable[str]:
+		'''The fields of MacroSet set by `update_macroset()`'''
+	@abstractmethod
+	def open_userdata (self) -> io.TextIOBase: ...
 	@abstractmethod
 	def poll_int_sched (self) -> InterruptSchedule: ...
+
+	def counters (self) -> dict[str, int]:
+		'''The counts of the requests made to the meta data service'''
+		return {}
+
+def boot_age () -> float:
+	'''Seconds since the system boot. Close enough to the age of the instance.'''
+	if hasattr(time, "CLOCK_BOOTTIME"):
+		return time.clock_gettime(time.CLOCK_BOOTTIME)
+	return time.monotonic()
+
+def boot_id () -> str | None:
+	'''Changes every boot. None if not available(non-Linux)'''
+	try:
+		with open("/proc/sys/kernel/random/boot_id") as f:
+			return f.read().strip()
+	except OSError:
+		return None
+
+class StateCache:
+	'''
+	The outcome of the last successful init: the meta data and what the
+	directives ended up with. Persisted so that a restart can verify them
+	locally and skip the calls to the cloud.
+
+	The meta data are only good for the same boot. The directive entries are
+	only good for the same instance and config. Each directive verifies its
+	entry on its own.
+	'''
+
+	def __init__ (self, path: str):
+		self.path = path
+		self._doc = dict[str, Any]()
+		self._entries = dict[str, dict[str, Any]]()
+		self._lock = threading.Lock()
+
+	def load (self) -> bool:
+		try:
+			with open(self.path) as f:
+				doc = json.load(f)
+		except FileNotFoundError:
+			return False
+		except (OSError, ValueError) as e:
+			pexcept(e, "Ignoring state cache")
+			return False
+
+		if not isinstance(doc, dict):
+			return False
+		self._doc = doc
+		return True
+
+	def meta (self, config_hash: str) -> dict[str, Any] | None:
+		'''The meta data if saved in the same boot with the same config(that
+		decides which fields are fetched)'''
+		bid = boot_id()
+		if (bid and self._doc.get("boot_id") == bid and
+				self._doc.get("config_hash") == config_hash):
+			return self._doc.get("meta")
+		return None
+
+	def validate (self, instance_id: str, config_hash: str):
+		'''Drop the directive entries saved for another instance or config'''
+		if (self._doc.get("instance_id") != instance_id or
+				self._doc.get("config_hash") != config_hash):
+			self._doc.pop("entries", None)
+
+	def get (self, kind: str, key: str) -> dict[str, Any] | None:
+		return self._doc.get("entries", {}).get(kind + ":" + key)
+
+	def put (self, kind: str, key: str, ent: dict[str, Any]):
+		with self._lock:
+			self._entries[kind + ":" + key] = ent
+
+	def save (self, instance_id: str, config_hash: str, meta: dict[str, Any]):
+		'''Replace the file with the entries put in this run'''
+		with self._lock:
+			doc = {
+				"boot_id": boot_id(),
+				"instance_id": instance_id,
+				"config_hash": config_hash,
+				"meta": meta,
+				"entries": self._entries
+			}
+
+		os.makedirs(os.path.dirname(self.path), mode = 0o700, exist_ok = True)
+		tmp = self.path + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump(doc, f, default = str)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, self.path)
+		self._doc = doc
+
+	def remove (self):
+		self._doc = {}
+		try:
+			os.unlink(self.path)
+		except FileNotFoundError:
+			pass
+
+class PollSchedule:
+	'''Computes the delay until the next interruption notice poll.
+
+	The interval shrinks linearly from `interval` to `min_interval` as the
+	instance ages over `ramp` seconds. When `budget` is set, the delay is
+	clamped so that the delay plus the observed round trip time stays in the
+	latency budget. Consecutive poll errors back the delay off exponentially
+	up to `backoff_max`, regardless of the budget.'''
+
+	def __init__ (
+			self,
+			interval: float = magic.Code.POLL_INTERVAL,
+			min_interval: float = magic.Code.POLL_MIN_INTERVAL,
+			ramp: float = magic.Code.POLL_RAMP,
+			jitter: float = magic.Code.POLL_JITTER,
+			backoff_max: float = magic.Code.POLL_BACKOFF_MAX,
+			budget: float | None = None):
+		if min_interval > interval:
+			raise ValueError("min-interval greater than interval")
+		if not 0 <= jitter < 1:
+			raise ValueError(str(jitter) + ": invalid jitter")
+
+		self.interval = float(interval)
+		self.min_interval = float(min_interval)
+		self.ramp = float(ramp)
+		self.jitter = float(jitter)
+		self.backoff_max = float(backoff_max)
+		self.budget = None if budget is None else float(budget)
+		self._rng = random.Random()
+
+	def from_conf (conf: dict[str, Any] | None):
+		if conf is None:
+			conf = {}
+
+		detect = conf.get("detect", "poll")
+		if detect != "poll":
+			raise ValueError(detect + ": unsupported interrupt detection")
+
+		opts = conf.get("options", {})
+		interval = opts.get("interval", magic.Code.POLL_INTERVAL)
+		return PollSchedule(
+			interval,
+			opts.get(
+				"min-interval",
+				min(interval, magic.Code.POLL_MIN_INTERVAL)),
+			opts.get("ramp", magic.Code.POLL_RAMP),
+			opts.get("jitter", magic.Code.POLL_JITTER),
+			opts.get("backoff-max", magic.Code.POLL_BACKOFF_MAX),
+			opts.get("latency-budget"))
+
+	def base (self, age: float) -> float:
+		if self.ramp <= 0 or age >= self.ramp:
+			return self.min_interval
+
+		r = age / self.ramp
+		return self.interval - (self.interval - self.min_interval) * r
+
+	def next (self, age: float, errors: int = 0, rtt: float = 0.0) -> float:
+		ret = self.base(age)
+
+		if self.jitter:
+			ret *= self._rng.uniform(1.0 - self.jitter, 1.0 + self.jitter)
+		if self.budget is not None:
+			ret = min(ret, self.budget - rtt)
+		ret = max(ret, magic.Code.POLL_FLOOR)
+
+		if errors > 0:
+			# the exponent is capped so that it doesn't overflow
+			ret = min(
+				ret * (2 ** min(errors, magic.Code.POLL_BACKOFF_STEPS)),
+				max(ret, self.backoff_max))
+
+		return ret
+
+class InterruptWatcher:
+	'''Polls the interruption notice in a background thread and sets `event`
+	as soon as a valid notice is received.'''
+
+	def __init__ (
+			self,
+			mm: MetaManager,
+			sched: PollSchedule,
+			on_error: Callable[[Exception, int], Any] | None = None):
+		self.event = threading.Event()
+		self.int_sched: InterruptSchedule | None = None
+		self.polls = 0
+		self.errors = 0
+		self.rtt = 0.0
+		self._mm = mm
+		self._sched = sched
+		self._on_error = on_error
+		self._stop = threading.Event()
+		self._th = threading.Thread(
+			target = self._main,
+			name = "interrupt-watcher",
+			daemon = True)
+
+	def start (self):
+		self._th.start()
+
+	def stop (self):
+		self._stop.set()
+
+	def wait (self, timeout: float | None = None) -> InterruptSchedule | None:
+		self.event.wait(timeout)
+		return self.int_sched
+
+	def _main (self):
+		errors = 0
+
+		while not self._stop.is_set():
+			started = time.monotonic()
+			try:
+				int_sched = self._mm.poll_int_sched()
+			except Exception as e:
+				errors += 1
+				self.errors += 1
+				if self._on_error:
+					self._on_error(e, errors)
+			else:
+				errors = 0
+				rtt = time.monotonic() - started
+				w = magic.Code.POLL_RTT_WEIGHT
+				self.rtt = (1 - w) * self.rtt + w * rtt if self.rtt else rtt
+
+				if int_sched and int_sched.valid():
+					self.int_sched = int_sched
+					self.event.set()
+					return
+			finally:
+				self.polls += 1
+
+			try:
+				delay = self._sched.next(boot_age(), errors, self.rtt)
+			except Exception as e:
+				# the thread must not die. The main thread waits on it.
+				delay = self._sched.backoff_max
+				if self._on_error:
+					self._on_error(e, errors)
+			self._stop.wait(max(0.0, delay - (time.monotonic() - started)))
+
+def parse_uevent (buf: bytes) -> dict[str, str] | None:
+	'''Parse a kernel uevent message("ACTION@DEVPATH\\0KEY=VALUE\\0...")'''
+	l = buf.split(b'\0')
+	if b'@' not in l[0]:
+		# not from the kernel (libudev)
+		return None
+
+	ret = dict[str, str]()
+	for kv in l[1:]:
+		k, sep, v = kv.partition(b'=')
+		if sep:
+			ret[k.decode(errors = "replace")] = v.decode(errors = "replace")
+
+	return ret
+
+class UEventMonitor:
+	'''Listens on the kernel uevent netlink socket so that the threads waiting
+	for devices wake up exactly when something happens to the subsystem rather
+	than spin waiting. Falls back to spin waiting when the socket is not
+	available(non-Linux or no permission).'''
+
+	def __init__ (self, subsystem: str = "block"):
+		self.cbset = set[Callable[[dict[str, str]], Any]]()
+		self._subsystem = subsystem
+		self._cond = threading.Condition()
+		self._gen = 0
+		self._sock: socket.socket | None = None
+		self._stop = threading.Event()
+		self._th: threading.Thread | None = None
+
+	def __enter__ (self):
+		self.start()
+		return self
+
+	def __exit__ (self, *exc):
+		self.stop()
+		return False
+
+	def listening (self) -> bool:
+		return self._th is not None and self._th.is_alive()
+
+	def start (self) -> bool:
+		if self._th:
+			return self.listening()
+
+		try:
+			sock = socket.socket(
+				socket.AF_NETLINK,
+				socket.SOCK_DGRAM,
+				magic.Code.NETLINK_KOBJECT_UEVENT)
+		except (AttributeError, OSError):
+			return False
+
+		try:
+			try:
+				sock.setsockopt(
+					socket.SOL_SOCKET,
+					socket.SO_RCVBUF,
+					magic.Code.UEVENT_RCVBUF)
+			except OSError:
+				pass
+			# group 1: kernel events
+			sock.bind(( 0, 1 ))
+			sock.settimeout(magic.Code.UEVENT_RECHECK)
+		except OSError:
+			sock.close()
+			return False
+
+		self._sock = sock
+		self._th = threading.Thread(
+			target = self._main,
+			name = "uevent-monitor",
+			daemon = True)
+		self._th.start()
+
+		return True
+
+	def stop (self):
+		# the thread closes the socket on its way out
+		self._stop.set()
+
+	def bump (self):
+		'''Wake up all waiters'''
+		with self._cond:
+			self._gen += 1
+			self._cond.notify_all()
+
+	def _main (self):
+		with self._sock:
+			while not self._stop.is_set():
+				try:
+					buf = self._sock.recv(65536)
+				except TimeoutError:
+					continue
+				except OSError:
+					# ENOBUFS: events lost. Let the waiters recheck.
+					self.bump()
+					continue
+
+				evt = parse_uevent(buf)
+				if evt is None or evt.get("SUBSYSTEM") != self._subsystem:
+					continue
+
+				for cb in self.cbset:
+					cb(evt)
+				self.bump()
+
+	def wait_for (
+			self,
+			pred: Callable[[], Any],
+			timeout: float | None = None) -> Any:
+		'''Wait until `pred` returns a truthy value, which is then returned.
+		`pred` is evaluated every time an event arrives. Returns None on
+		timeout.'''
+		if timeout is not None:
+			end = time.monotonic() + timeout
+
+		while True:
+			with self._cond:
+				gen = self._gen
+
+			ret = pred()
+			if ret:
+				return ret
+
+			if self.listening():
+				interval = magic.Code.UEVENT_RECHECK
+			else:
+				interval = magic.Code.DEVICE_WAIT
+
+			if timeout is not None:
+				remaining = end - time.monotonic()
+				if remaining <= 0:
+					return None
+				interval = min(interval, remaining)
+
+			with self._cond:
+				self._cond.wait_for(lambda: self._gen != gen, interval)
+
+class StartupProfile:
+	'''Records the time spent in each phase of the startup'''
+
+	def __init__ (self, t0: float | None = None):
+		self.t0 = time.perf_counter() if t0 is None else t0
+		self.phases = list[tuple[str, float]]()
+		self._last = self.t0
+
+	def mark (self, name: str):
+		'''Mark the end of the phase'''
+		now = time.perf_counter()
+		self.phases.append(( name, now - self._last ))
+		self._last = now
+
+	def report (self, out: io.TextIOBase, extra: dict[str, float] = {}) -> int:
+		ret = 0
+		for name, elapsed in self.phases:
+			ret += out.write('''{name:<24}{ms:10.3f} ms{nl}'''.format(
+				name = name,
+				ms = elapsed * 1000,
+				nl = os.linesep))
+		for name, elapsed in extra.items():
+			ret += out.write('''  ({name:<20}{ms:10.3f} ms){nl}'''.format(
+				name = name,
+				ms = elapsed * 1000,
+				nl = os.linesep))
+		ret += out.write('''{name:<24}{ms:10.3f} ms{nl}'''.format(
+			name = "total",
+			ms = (self._last - self.t0) * 1000,
+			nl = os.linesep))
+
+		return ret
@@ -1,22 +1,20 @@
+import time
+
+_t0 = time.perf_counter()
+
+import functools
 import getopt
-import glob
 import io
 import random
 import signal
 import socket
 import sys
 import threading
-import time
 import traceback
 import uuid
 from concurrent import futures
 from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
-
-import boto3
-import botocore
-import pyjson5
-import sdnotify
+from typing import Iterator
 
 import ec2fleetd
 from ec2fleetd import *
@@ -25,6 +23,9 @@ from ec2fleetd.exceptions import *
 
 assert(threading.current_thread() == threading.main_thread())
 
+startup_prof = StartupProfile(_t0)
+startup_prof.mark("imports")
+
 stdout_lock = threading.Lock()
 
 class EC:
@@ -47,6 +48,11 @@ class RunParam:
 		self.enable_notify = True
 		self.enable_exec = True
 		self.enable_poll = True
+		self.startup_profile = False
+		self.sweep: str = None
+		self.region: str = None
+		self.min_age: float = None
+		self.state_dir = magic.Code.STATE_DIR
 
 	def disable_all (self):
 		self.enable_init = False
@@ -77,7 +83,18 @@ Options:
   --enable-notify=<BOOL>  enable notify directives
   --enable-exec=<BOOL>    enable exec directives
   --enable-poll=<BOOL>    enable polling of interruption notice
-'''.format(program = program))
+  --startup-profile       print the time spent in each startup phase upon
+                          READY
+  --sweep=<DOMAIN>        clean up the resources abandoned by the inits of
+                          the domain and exit. For running on a schedule
+  --region=<STR>          the region to sweep. Defaults to the Boto3 default,
+                          then the region of the instance
+  --min-age=<SECS>        sweep the transactions older than this. Defaults to
+                          the init timeout of the --userdata config plus the
+                          rollback grace period
+  --state-dir=<DIR>       where the transaction journals are kept. Defaults to
+                          {state_dir}
+'''.format(program = program, state_dir = magic.Code.STATE_DIR))
 
 def parse_argv (argv: list) -> RunParam:
 	ret = RunParam()
@@ -95,7 +112,12 @@ def parse_argv (argv: list) -> RunParam:
 			"enable-init=",
 			"enable-notify=",
 			"enable-exec=",
-			"enable-poll="
+			"enable-poll=",
+			"startup-profile",
+			"sweep=",
+			"region=",
+			"min-age=",
+			"state-dir="
 		])
 	for opt in opts:
 		match opt[0]:
@@ -106,7 +128,10 @@ def parse_argv (argv: list) -> RunParam:
 			case "--userdata": ret.userdata = opt[1]
 			case "--transc_id":
 				ret.transc_id = opt[1]
-				if not ret.transc_id:
+				# used as the name of the journal directory
+				if (not ret.transc_id or
+						os.path.basename(ret.transc_id) != ret.transc_id or
+						ret.transc_id in [ ".", ".." ]):
 					raise ValueError(ret.transc_id + ": invalid --transc_id option")
 			case "--profile":
 				ret.profile = opt[1]
@@ -120,23 +145,31 @@ def parse_argv (argv: list) -> RunParam:
 				ret.enable_exec = ec2fleetd.parse_bool(opt[1])
 			case "--enable-poll":
 				ret.enable_poll = ec2fleetd.parse_bool(opt[1])
+			case "--startup-profile":
+				ret.startup_profile = True
+			case "--sweep":
+				ret.sweep = opt[1]
+				if not ret.sweep:
+					raise ValueError(ret.sweep + ": invalid --sweep option")
+			case "--region":
+				ret.region = opt[1]
+			case "--min-age":
+				ret.min_age = float(opt[1])
+				if ret.min_age < 0:
+					raise ValueError(opt[1] + ": invalid --min-age option")
+			case "--state-dir":
+				ret.state_dir = opt[1]
 
 	return ret
 
 # parse options
 try:
 	run_param = parse_argv(sys.argv[1:])
-	mm = aws.EC2MetaManager(run_param.imds)
-except ValueError as e:
+except (ValueError, getopt.GetoptError) as e:
 	with stdout_lock:
 		ec2fleetd.pexcept(e)
 	exit(EC.USAGE_ERR)
 
-def open_userdata () -> io.BufferedIOBase:
-	if run_param.userdata:
-		return open(run_param.userdata, "r")
-	return mm.open_userdata()
-
 # do print options
 if run_param.version:
 	print_ver(sys.stdout)
@@ -146,13 +179,157 @@ if run_param.help:
 if run_param.version or run_param.help:
 	exit(EC.OK)
 
+def sweep_min_age () -> float:
+	if run_param.min_age is not None:
+		return run_param.min_age
+
+	init_timeout = magic.Code.INIT_TIMEOUT
+	if run_param.userdata:
+		import pyjson5
+
+		with open(run_param.userdata, "r") as f:
+			init_timeout = pyjson5.load(f).get("timeout", init_timeout)
+
+	ret = aws.sweep_min_age(init_timeout)
+	if ret is None:
+		raise ValueError("The init has no timeout. Use --min-age")
+	return ret
+
+def sweep_region (pool: aws.AWSClientPool) -> str | None:
+	'''The timer unit runs the sweeper on the instances without --region'''
+	ret = run_param.region or pool.default_region()
+	if ret:
+		return ret
+
+	try:
+		return aws.EC2MetaManager(run_param.imds).session.get(
+			"meta-data/placement/region")
+	except Exception as e:
+		with stdout_lock:
+			ec2fleetd.pexcept(e, "Getting the region from IMDS")
+
+	return None
+
+def do_sweep () -> int:
+	'''
+	The standalone mode. Does not require the IMDS so that it can be run from
+	anywhere.
+	'''
+	try:
+		min_age = sweep_min_age()
+	except Exception as e:
+		# a bad option or config
+		with stdout_lock:
+			ec2fleetd.pexcept(e)
+		return EC.USAGE_ERR
+
+	pool = aws.AWSClientPool(run_param.profile)
+	result = aws.clean_up_transc(
+		pool,
+		sweep_region(pool),
+		domain = run_param.sweep,
+		min_age = min_age)
+
+	print(json.dumps(
+		[ log.dict() for log in result[0] ],
+		indent = '\t',
+		default = str))
+	if result[1]:
+		ec2fleetd.pexcept(result[1], "Sweeping " + run_param.sweep)
+		return EC.GENERIC_ERR
+	return EC.OK
+
+if run_param.sweep:
+	exit(do_sweep())
+
+# deferred so that the options above can be printed quickly
+import pyjson5
+import sdnotify
+
+try:
+	mm = aws.EC2MetaManager(run_param.imds)
+except ValueError as e:
+	with stdout_lock:
+		ec2fleetd.pexcept(e)
+	exit(EC.USAGE_ERR)
+
+def open_userdata () -> io.TextIOBase:
+	if run_param.userdata:
+		return open(run_param.userdata, "r")
+	return mm.open_userdata()
+
 sdn = sdnotify.SystemdNotifier()
+startup_prof.mark("argv")
+
+def mk_state_cache_path () -> str:
+	# one for each config(instance of the service)
+	if run_param.userdata:
+		name = hashlib.sha256(
+			os.path.abspath(run_param.userdata).encode()).hexdigest()[:16]
+	else:
+		name = "userdata"
+
+	return os.path.join(run_param.state_dir, "cache", name + ".json")
+
+state_cache = StateCache(mk_state_cache_path())
+
+with open_userdata() as f:
+	try:
+		fleet_conf = pyjson5.load(f)
+	except pyjson5.Json5EOF:
+		if f.tell() == 0:
+			sys.stderr.write("Empty user data. Bye bye!" + os.linesep)
+			exit(EC.OK)
+		raise
+startup_prof.mark("userdata")
+
+config_hash = hashlib.sha256(
+	json.dumps(fleet_conf, sort_keys = True).encode()).hexdigest()
+
+# used by the daemon itself regardless of the config
+DAEMON_META_FIELDS = [
+	"instance_id",
+	"instance_index",
+	"placement_region",
+	"placement_zone",
+	"hypervisor",
+	"primary_public_ipv4",
+	"primary_public_ipv6"
+]
+
+def mk_meta_fields () -> set[str]:
+	'''The fields of the meta data used by the daemon or the config'''
+	names = referenced_macros(fleet_conf)
+	if any(
+			dconf.get("notify")
+			for dconf in fleet_conf.get("domains", {}).values()):
+		# the default envelope
+		names |= compile_macro(magic.Notify.SUBJECT).names
+		names |= compile_macro(magic.Notify.BODY).names
+
+	all_fields = set(mm.meta_fields())
+	if "all_json" in names:
+		return all_fields
+	return (names & all_fields) | set(DAEMON_META_FIELDS)
+
+def fetch_meta ():
+	'''From the state cache if it's still good. Fetch otherwise'''
+	meta = state_cache.meta(config_hash) if state_cache.load() else None
+	if meta:
+		for k in mm.meta_fields():
+			setattr(ms, k, meta.get(k))
+		if mm.verify_meta(ms):
+			return
+
+	mm.fetch_meta(ms, mk_meta_fields())
 
 # crawl data
 ms = MacroSet()
 ms.daemon_state = DaemonState.STARTING
 ms.transaction_id = run_param.transc_id
-mm.fetch_meta(ms)
+fetch_meta()
+startup_prof.mark("imds")
+state_cache.validate(ms.instance_id, config_hash)
 
 # warn unsupported hypervisor system
 if not magic.is_supported_hv(ms.hypervisor):
@@ -162,15 +339,6 @@ if not magic.is_supported_hv(ms.hypervisor):
 			nl = os.linesep)
 	)
 
-with open_userdata() as f:
-	try:
-		fleet_conf = pyjson5.load(f)
-	except pyjson5.Json5EOF:
-		if f.tell() == 0:
-			sys.stderr.write("Empty user data. Bye bye!" + os.linesep)
-			exit(EC.OK)
-		raise
-
 '''
 Start from cheap to expensive in terms of monetary cost. Run them in a child so
 that you could time it. Do in this order.
@@ -205,12 +373,8 @@ def handle_interrupt (sn, *args):
 
 	raise InterruptedError("Interrupted by signal #" + str(sn))
 
-def handle_timeout (sn, *args):
-	raise TimeoutError()
-
 signal.signal(signal.SIGINT, handle_interrupt)
 signal.signal(signal.SIGTERM, handle_interrupt)
-signal.signal(signal.SIGALRM, handle_timeout)
 
 def mk_dexecutor (max_workers = None):
 	if max_workers is None:
@@ -219,10 +383,12 @@ def mk_dexecutor (max_workers = None):
 	return ThreadPoolExecutor(max_workers)
 
 def fs_wait_all (fs: list[futures.Future], timeout: float = None):
-	futures.wait(
-		# timeout = timeout, # TODO
+	_, not_done = futures.wait(
+		timeout = timeout,
 		fs = fs,
 		return_when = futures.ALL_COMPLETED)
+	if not_done:
+		raise TimeoutError()
 
 def fs_cancel_all (fs: list[futures.Future]):
 	for f in fs:
@@ -244,47 +410,97 @@ def filter_transient_vols (
 
 	return ret
 
-def wait_for_path (path: str) -> str:
-	if glob.glob(path):
-		return path
-	return
+# wakes up the threads waiting for the attached volumes
+dev_mon = UEventMonitor("block")
+dev_mon.cbset.add(aws.blockdev_index.invalidate)
+
+# the volumes attached for the domains. Stamped with "ts-used" on exit
+used_vols = list[tuple[Callable[[], aws.BotoClientWrapper], str]]()
+
+POOL_PREFS = [
+	"index",
+	"random",
+	"least-recently-used",
+	"most-recently-used"
+]
 
 def do_volume (
 		conf: dict[str, Any],
 		ms: MacroSet,
 		t_parent: TransientResourceManager,
 		t_logger: ResourceTransactionLogger,
-		client: aws.BotoClientWrapper):
+		get_client: Callable[[], aws.BotoClientWrapper],
+		deadline: Deadline):
 	dev_path = conf["device"]
 	src_p = conf["source"]
 	vid = conf.get("volume-id")
 	pname = conf.get("pool-name")
 	create_param = conf.get("create")
+	pool_pref = conf.get("pool-pref", "index")
 	rng = random.Random()
 
+	if pool_pref not in POOL_PREFS:
+		raise ValueError(pool_pref + ": invalid \"pool-pref\"")
+
+	def describe_attached () -> Iterator[dict[str, Any]]:
+		'''
+		The volumes attached to this instance. The query is the same for all
+		volume specs in all domains so that the concurrent calls are coalesced
+		into one.
+		'''
+		for rsp in client.do_paginate(
+				"describe_volumes",
+				t_logger,
+				Filters = [
+					{
+						"Name": "attachment.instance-id",
+						"Values": [ ms.instance_id ]
+					},
+					{
+						"Name": "attachment.status",
+						"Values": [ "attached" ]
+					}
+				],
+				MaxResults = aws.Magic.Code.EC2_VOL_PAGE_SIZE):
+			yield from rsp["Volumes"]
+
+	def describe_pool () -> Iterator[list[dict[str, Any]]]:
+		'''
+		The volumes in the pool, page by page. The policies that need the whole
+		pool get it in one list.
+		'''
+		pages = (
+			rsp["Volumes"]
+			for rsp in client.do_paginate(
+				"describe_volumes",
+				t_logger,
+				Filters = [
+					{
+						"Name": "tag:" + aws.Magic.TagName.DOMAIN,
+						"Values": [ ms.domain ]
+					},
+					{
+						"Name": "tag:" + aws.Magic.TagName.POOL_NAME,
+						"Values": [ pname ]
+					},
+					{
+						"Name": "availability-zone",
+						"Values": [ ms.placement_zone ]
+					}
+				],
+				MaxResults = aws.Magic.Code.EC2_VOL_PAGE_SIZE) )
+
+		if pool_pref == "random":
+			yield from pages
+		else:
+			yield [ v for page in pages for v in page ]
+
 	def src_vol_x (transc: TransientResourceManager) -> int:
-		rsp = client.do_call(
-			"describe_volumes",
-			t_logger,
-			Filters = [
-				{
-					"Name": "attachment.instance-id",
-					"Values": [ ms.instance_id ]
-				},
-				{
-					"Name": "attachment.status",
-					"Values": [ "attached" ]
-				},
-				{
-					"Name": "volume-id",
-					"Values": [ vid ]
-				}
-			])
-		vol = rsp["Volumes"]
-
-		assert len(vol) <= 1
-		if len(vol):
-			vol = vol[0]
+		vol = next(
+			( v for v in describe_attached() if v["VolumeId"] == vid ),
+			None)
+
+		if vol:
 			for att in vol["Attachments"]:
 				if att["InstanceId"] == ms.instance_id:
 					att_dev = att["Device"]
@@ -305,7 +521,8 @@ def do_volume (
 				client,
 				vid,
 				ms.transaction_id,
-				t_logger) ])
+				t_logger,
+				ms.instance_id) ])
 
 			client.do_call(
 				"create_tags",
@@ -314,38 +531,57 @@ def do_volume (
 				Tags = [{
 					"Key": aws.Magic.TagName.TRANSC_ID,
 					"Value": ms.transaction_id }])
-		except botocore.exceptions.ClientError:
+		except aws.ClientError:
 			return -1
 		else:
 			return 1
 
+	def ts_used_key (vol: dict[str, Any]) -> tuple[bool, datetime.datetime]:
+		ts = aws.get_ts_used(vol)
+		return ( ts is not None, ts or aws.Magic.Code.TS_NEVER )
+
+	def rank_vols (
+			vols: list[dict[str, Any]],
+			tried: set[str]) -> list[str]:
+		'''
+		The available volumes in the order of preference. The volumes are
+		ranked by rendezvous hashing on the instance id first so that the
+		instances starting at the same time go for different volumes.
+		'''
+		avail = [
+			v for v in filter_transient_vols(vols)
+			if v["VolumeId"] not in tried ]
+		ret = hrw_rank(ms.instance_id, [ v["VolumeId"] for v in avail ])
+
+		match pool_pref:
+			case "index":
+				if ms.instance_index is not None and ret and not tried:
+					first = vols[ms.instance_index % len(vols)]["VolumeId"]
+					if first in ret:
+						ret.remove(first)
+						ret.insert(0, first)
+			case "random":
+				rng.shuffle(ret)
+			case "least-recently-used" | "most-recently-used":
+				# the ones never used come first for LRU. The ties are broken
+				# by the rank
+				ts = { v["VolumeId"]: ts_used_key(v) for v in avail }
+				ret.sort(
+					key = lambda id: ts[id],
+					reverse = pool_pref == "most-recently-used")
+
+		return ret
+
 	def src_vol_p (transc: TransientResourceManager) -> int:
 		nonlocal vid
-		run_cnt = 0
+		# the volumes that have been tried
+		tried = set[str]()
+
+		for vol in describe_attached():
+			if (aws.get_tag(vol, aws.Magic.TagName.DOMAIN) != ms.domain or
+					aws.get_tag(vol, aws.Magic.TagName.POOL_NAME) != pname):
+				continue
 
-		rsp = client.do_call(
-			"describe_volumes",
-			t_logger,
-			Filters = [
-				{
-					"Name": "tag:" + aws.Magic.TagName.DOMAIN,
-					"Values": [ ms.domain ]
-				},
-				{
-					"Name": "tag:" + aws.Magic.TagName.POOL_NAME,
-					"Values": [ pname ]
-				},
-				{
-					"Name": "attachment.instance-id",
-					"Values": [ ms.instance_id ]
-				},
-				{
-					"Name": "attachment.status",
-					"Values": [ "attached" ]
-				}
-			])
-
-		for vol in rsp["Volumes"]:
 			for att in vol["Attachments"]:
 				if att["InstanceId"] == ms.instance_id:
 					att_dev = att["Device"]
@@ -361,84 +597,64 @@ def do_volume (
 								att_dev = att_dev))
 
 		while True:
-			rsp = client.do_call(
-				"describe_volumes",
-				t_logger,
-				Filters = [
-					{
-						"Name": "tag:" + aws.Magic.TagName.DOMAIN,
-						"Values": [ ms.domain ]
-					},
-					{
-						"Name": "tag:" + aws.Magic.TagName.POOL_NAME,
-						"Values": [ pname ]
-					},
-					{
-						"Name": "availability-zone",
-						"Values": [ ms.placement_zone ]
-					}
-				])
-
-			if len(rsp["Volumes"]) == 0:
-				return -1
-
-			def pick_vol ():
-				'''
-				Depends on the assumption that the order of volumes in the list are
-				somewhat persistent. Otherwise, the response should be sorted using
-				our own criteria.
-				'''
-				if run_cnt == 0 and ms.instance_index is not None:
-					vols = rsp["Volumes"]
-					vol_len = len(vols)
-
-					ret = vols[ms.instance_index % vol_len]
-					if ret["State"] == "available":
-						return ret["VolumeId"]
-
-				vols = filter_transient_vols(rsp["Volumes"])
-				vol_len = len(vols)
-
-				if False and run_cnt != 0: # FIXME
-					# this case will cause thundering herd. Needs to be fixed.
-					with stdout_lock:
-						sys.stderr.write(
-							"No instance index. Picking random volume from pool")
-
-				if vol_len == 0:
-					return None
-
-				return vols[rng.randint(0, vol_len - 1)]["VolumeId"]
-
-			vid = pick_vol()
-			if not vid:
-				return -1
-
-			try:
-				client.do_call(
-					"attach_volume",
-					t_logger,
-					Device = dev_path,
-					InstanceId = ms.instance_id,
-					VolumeId = vid)
+			deadline.check()
+			found = False
+
+			# Go down the list. The pool is described again only when all of
+			# them are taken.
+			for cand in (
+					cand
+					for vols in describe_pool()
+					for cand in rank_vols(vols, tried)):
+				deadline.check()
+				found = True
+				tried.add(cand)
+
+				try:
+					if not aws.claim_vol(
+							client,
+							cand,
+							ms.transaction_id,
+							ms.instance_id,
+							t_logger):
+						# claimed by someone else
+						continue
+				except aws.ClientError:
+					continue
+
+				try:
+					client.do_call(
+						"attach_volume",
+						t_logger,
+						Device = dev_path,
+						InstanceId = ms.instance_id,
+						VolumeId = cand)
+				except aws.ClientError:
+					try:
+						aws.release_vol(
+							client,
+							cand,
+							ms.transaction_id,
+							ms.instance_id,
+							t_logger)
+					except aws.ClientError:
+						pass # left for the sweeper
+					continue
+
+				vid = cand
+				# tags again in case the claim was overwritten by someone who
+				# lost the race to attach
 				transc.push([ aws.EC2AttachedVolumeHold(
 					client,
 					vid,
 					ms.transaction_id,
-					t_logger) ])
-
-				client.do_call(
-					"create_tags",
 					t_logger,
-					Resources = [ vid ],
-					Tags = [{
-						"Key": aws.Magic.TagName.TRANSC_ID,
-						"Value": ms.transaction_id
-					}])
+					ms.instance_id) ])
 
 				return 1
-			except botocore.exceptions.ClientError:
-				run_cnt += 1
+
+			if not found:
+				return -1
 
 	def src_vol_c (transc: TransientResourceManager) -> int:
 		nonlocal vid
@@ -475,7 +691,7 @@ def do_volume (
 		wait_steps = aws.EC2VolumeCreatePollWaitStep()
 		while state == "creating":
 			wait_time = wait_steps.next()
-			time.sleep(wait_time)
+			deadline.sleep(wait_time)
 
 			rsp = client.do_call(
 				"describe_volumes",
@@ -494,27 +710,53 @@ def do_volume (
 			client,
 			vid,
 			ms.transaction_id,
-			t_logger) ])
+			t_logger,
+			ms.instance_id) ])
 
 		return 1
 
-	local_ms = deepcopy(ms)
+	def src_vol_cached () -> str | None:
+		'''
+		The source of the volume attached in the last run if it's still
+		attached as the same device. Checked locally with the serial in sysfs.
+		'''
+		nonlocal vid
+		ent = state_cache.get("attach-volume", dev_path)
+		if not ent:
+			return None
+
+		dev = aws.find_blockdev_by_vid(ent["volume-id"])
+		if not dev or dev != ent["attached-device"]:
+			return None
+
+		vid = ent["volume-id"]
+		return ent["source"]
+
+	local_ms = ms.overlay()
 	with TransientResourceManager(conf.get("critical", True), t_parent) as transc:
 		rv = -1
-		for src in src_p:
-			match src:
-				case 'x':
-					rv = src_vol_x(transc)
-				case 'p':
-					rv = src_vol_p(transc)
-				case 'c':
-					rv = src_vol_c(transc)
-				case _:
-					raise ValueError(src + ": invalid source spec")
-
-			if rv >= 0:
-				local_ms.attach_source = src
-				break
+		src = src_vol_cached()
+		if src:
+			rv = 0
+			local_ms.attach_source = src
+		else:
+			client = get_client()
+
+			for src in src_p:
+				deadline.check()
+				match src:
+					case 'x':
+						rv = src_vol_x(transc)
+					case 'p':
+						rv = src_vol_p(transc)
+					case 'c':
+						rv = src_vol_c(transc)
+					case _:
+						raise ValueError(src + ": invalid source spec")
+
+				if rv >= 0:
+					local_ms.attach_source = src
+					break
 
 		if rv < 0:
 			raise NoVolumeSourceError(dev_path + ": no source available")
@@ -527,24 +769,41 @@ def do_volume (
 
 		assert vid
 		# Wait for the device to come up
-		# FIXME: rpc udev rather than spin wait
-		while True:
-			local_ms.attached_device = (
+		local_ms.attached_device = dev_mon.wait_for(
+			lambda: (
+				# cut short when the deadline is cancelled
+				deadline.check() or
 				aws.find_blockdev_by_vid(vid) or
-				wait_for_path(dev_path))
-			if local_ms.attached_device:
-				break
-			time.sleep(magic.Code.DEVICE_WAIT)
+				aws.find_blockdev_by_path(dev_path)),
+			deadline.clamp(
+				conf.get("device-timeout", magic.Code.DEVICE_TIMEOUT)))
+		if not local_ms.attached_device:
+			deadline.check()
+			raise TimeoutError(
+				'''{vid}: device did not appear as {dev_path}'''.format(
+					vid = vid,
+					dev_path = dev_path))
 
 		exec_mat = init_exec_mat(conf.get("exec", []), local_ms.format)
-		do_exec_mat(exec_mat)
+		do_exec_mat(exec_mat, deadline = deadline)
+
+		used_vols.append(( get_client, vid ))
+		state_cache.put("attach-volume", dev_path, {
+			"volume-id": vid,
+			"attached-device": local_ms.attached_device,
+			"source": local_ms.attach_source
+		})
+
+r53_batcher = aws.Route53ChangeBatcher()
+r53_sync = aws.Route53SyncWaiter()
 
 def do_route53 (
 		conf: dict[str, Any],
 		ms: MacroSet,
 		t_parent: TransientResourceManager,
 		t_logger: ResourceTransactionLogger,
-		client: aws.BotoClientWrapper):
+		get_client: Callable[[], aws.BotoClientWrapper],
+		deadline: Deadline):
 	hz = conf["hostedzone"]
 	rname = conf["name"]
 	rttl = conf["ttl"]
@@ -556,7 +815,7 @@ def do_route53 (
 			"Type": "A",
 			"TTL": rttl,
 			"ResourceRecords": [
-				{ "Value": s.strip() for s in ms.primary_public_ipv4.split(',') }
+				{ "Value": s.strip() } for s in ms.primary_public_ipv4.split(',')
 			]
 		})
 	if ms.primary_public_ipv6:
@@ -565,105 +824,227 @@ def do_route53 (
 			"Type": "AAAA",
 			"TTL": rttl,
 			"ResourceRecords": [
-				{ "Value": s.strip() for s in ms.primary_public_ipv6.split(',') }
+				{ "Value": s.strip() } for s in ms.primary_public_ipv6.split(',')
 			]
 		})
 
 	if not rrs:
+		r53_batcher.withdraw(hz, ms.domain)
 		return
 
-	with TransientResourceManager(conf.get("critical", True), t_parent) as transc:
-		rsp = client.do_call(
-			"list_resource_record_sets",
-			t_logger,
-			HostedZoneId = hz,
-			StartRecordName = rname)
-		saved = []
-		for rr in rsp["ResourceRecordSets"]:
-			if rr["Name"] != rname:
-				break
-			saved.append(rr)
+	# the same values as the last run
+	cache_key = hz + " " + aws.norm_r53_name(rname)
+	ent = state_cache.get("update-route53", cache_key)
+	if ent and ent["rrs"] == rrs:
+		r53_batcher.withdraw(hz, ms.domain)
+		state_cache.put("update-route53", cache_key, ent)
+		return
 
-		batch = { "Changes": aws.mk_r53_rrchanges("UPSERT", rrs) }
-		rsp = client.do_call(
-			"change_resource_record_sets",
-			t_logger,
-			HostedZoneId = hz,
-			ChangeBatch = batch)["ChangeInfo"]
-		change_id = rsp["Id"]
+	client: aws.BotoClientWrapper = None
 
-		# wait for sync???
-		# while rsp["Status"] == "PENDING":
-		# 	time.sleep(1)
-		# 	rsp = client.do_call("get_change", t_logger, Id = change_id)["ChangeInfo"]
+	def list_rrs () -> Iterator[dict[str, Any]]:
+		'''
+		The RRs with the name. The RRs are sorted by name so the listing stops
+		as soon as the name changes.
+		'''
+		for rsp in client.do_paginate(
+				"list_resource_record_sets",
+				t_logger,
+				HostedZoneId = hz,
+				StartRecordName = rname,
+				MaxItems = aws.Magic.Code.R53_RR_PAGE_SIZE):
+			for rr in rsp["ResourceRecordSets"]:
+				if aws.norm_r53_name(rr["Name"]) != aws.norm_r53_name(rname):
+					return
+				yield rr
 
+	with TransientResourceManager(conf.get("critical", True), t_parent) as transc:
+		# the existing RRs of the types to be changed
+		types = set(rr["Type"] for rr in rrs)
+		try:
+			deadline.check()
+			client = get_client()
+			saved = [ rr for rr in list_rrs() if rr["Type"] in types ]
+			deadline.check()
+		except:
+			# or the others would wait for this one until the linger
+			r53_batcher.withdraw(hz, ms.domain)
+			raise
+
+		# changes from other domains to the same zone go in the same batch
+		rsp = r53_batcher.submit(
+			client,
+			hz,
+			aws.mk_r53_rrchanges("UPSERT", rrs),
+			t_logger)
+		if conf.get("wait-insync"):
+			# the waiter is started once the init is complete
+			r53_sync.track(client, rsp["Id"])
+
+		# restore the ones updated and delete the ones inserted upon rollback
+		saved_types = set(rr["Type"] for rr in saved)
+		inserted = [ rr for rr in rrs if rr["Type"] not in saved_types ]
 		if saved:
 			transc.push([ aws.Route53UpdatedRRHold(client, hz, saved, t_logger) ])
-		else:
-			transc.push([ aws.Route53InsertedRRHold(client, hz, rrs, t_logger) ])
+		if inserted:
+			transc.push([
+				aws.Route53InsertedRRHold(client, hz, inserted, t_logger) ])
 
-def mk_profile ():
-	kwargs = dict[str, Any]()
-	if run_param.profile:
-		kwargs["profile_name"] = run_param.profile
-	kwargs["region_name"] = ms.placement_region
+		state_cache.put("update-route53", cache_key, { "rrs": rrs })
 
-	return boto3.session.Session(**kwargs)
+# null for no timeout
+init_timeout = fleet_conf.get("timeout", magic.Code.INIT_TIMEOUT)
 
-def do_domain_init (dname: str, conf: dict[str, Any]):
-	local_ms = deepcopy(ms)
-	local_ms.domain = dname
+def mk_client_pool () -> aws.AWSClientPool:
+	read_timeout = aws.Magic.Code.AWS_READ_TIMEOUT
+	if init_timeout is not None:
+		# a single call must not outlive the init
+		read_timeout = min(read_timeout, init_timeout)
+
+	# enough connections for all the directives of all domains in flight
+	conns = 0
+	for dconf in fleet_conf.get("domains", {}).values():
+		conns += dconf.get("concurrency", magic.Code.DIRECTIVE_CONCURRENCY)
+
+	return aws.AWSClientPool(
+		run_param.profile,
+		max(conns, aws.Magic.Code.AWS_MAX_POOL_CONNECTIONS),
+		read_timeout = read_timeout)
+
+aws_pool = mk_client_pool()
+aws.rate_limiter.configure(fleet_conf.get("rate-limits", {}))
 
-	session = mk_profile()
-	c_ec2 = session.client("ec2")
-	c_r53 = session.client("route53")
+def do_domain_init (
+		dname: str,
+		conf: dict[str, Any],
+		deadline: Deadline,
+		journal: TransactionJournal | None):
+	local_ms = ms.overlay()
+	local_ms.domain = dname
 
 	t_logger = ResourceTransactionLogger()
+	if journal:
+		t_logger.cbset.add(journal.log)
+
+	clients = list[aws.BotoClientWrapper]()
+
+	def mk_get_client (service: str) -> Callable[[], aws.BotoClientWrapper]:
+		def f () -> aws.BotoClientWrapper:
+			c = aws.BotoClientWrapper(
+				aws_pool.client(service, ms.placement_region),
+				dname,
+				deadline = deadline)
+			clients.append(c)
+			return c
+
+		return functools.cache(f)
+
+	directives = list[tuple[str, Callable, Callable]]()
+	# the clients(and the SDK) are loaded only if required. Not at all if the
+	# directives are satisfied by the state cache
+	if conf.get("attach-volume"):
+		directives.append(( "attach-volume", do_volume, mk_get_client("ec2") ))
+	if conf.get("update-route53"):
+		directives.append((
+			"update-route53",
+			do_route53,
+			mk_get_client("route53") ))
 
 	try:
-		with TransientResourceManager(True) as transc:
-			for vol_spec in conf.get("attach-volume", []):
-				do_volume(
-					vol_spec,
-					local_ms,
-					transc,
-					t_logger,
-					aws.BotoClientWrapper(c_ec2, dname))
+		with TransientResourceManager(True, journal = journal) as transc:
+			tasks = list[DAGTask]()
+
+			for kind, f, get_client in directives:
+				for i, spec in enumerate(conf.get(kind, [])):
+					tasks.append(DAGTask(
+						spec.get("id", '''{kind}[{i}]'''.format(kind = kind, i = i)),
+						functools.partial(
+							f,
+							spec,
+							local_ms,
+							transc,
+							t_logger,
+							get_client,
+							deadline),
+						spec.get("after")))
 
-			for r_spec in conf.get("update-route53", []):
-				do_route53(
-					r_spec,
-					local_ms,
-					transc,
-					t_logger,
-					aws.BotoClientWrapper(c_r53, dname))
+			try:
+				run_dag(
+					tasks,
+					conf.get("concurrency", magic.Code.DIRECTIVE_CONCURRENCY))
+			except:
+				# the init deadline is likely gone. The holds use the same
+				# clients, so give the rollback the grace period of its own
+				grace = Deadline(magic.Code.ROLLBACK_GRACE)
+				for c in clients:
+					c.deadline = grace
+				raise
 	except Exception as e:
 		exc = e
 	else:
 		exc = None
 
-	return ( dname, t_logger.logs, exc )
+	# the clients are used again on exit, long after the init deadline
+	for c in clients:
+		c.deadline = None
+
+	return ( dname, list(t_logger.logs), exc )
+
+# the results of the last execs run for each domain, for the notifications
+exec_results = dict[str, list[dict[str, Any]]]()
 
-def do_exec_domain (dname: str, conf: list[dict[str, Any]], event: str):
-	local_ms = deepcopy(ms)
+def do_exec_domain (
+		dname: str,
+		conf: list[dict[str, Any]],
+		event: str,
+		wildcard: bool = True,
+		deadline: Deadline | None = None):
+	local_ms = ms.overlay()
 	local_ms.domain = dname
 
 	exec_mat = init_exec_mat(conf, local_ms.format)
-	do_exec_mat(exec_mat, event)
+	results = list[ExecResult]()
+	try:
+		do_exec_mat(
+			exec_mat,
+			event,
+			wildcard,
+			deadline = deadline,
+			results = results,
+			# make the most of the time left
+			lenient = deadline is not None)
+	finally:
+		if results:
+			exec_results[dname] = [ r.dict() for r in results ]
 
-def do_exec ():
+def do_exec (
+		event: str | None = None,
+		deadline: Deadline | None = None,
+		domains: Iterable[str] | None = None):
 	if not run_param.enable_exec:
 		return
 
-	event = ms.daemon_state
+	if event is None:
+		event = ms.daemon_state
+		wildcard = True
+	else:
+		wildcard = False
 	fs = list[futures.Future]()
 
 	try:
 		with mk_dexecutor() as dpool:
 			for dname, dconf in fleet_conf.get("domains", {}).items():
+				if domains is not None and dname not in domains:
+					continue
 				conf = dconf.get("exec")
 				if conf:
-					f = dpool.submit(do_exec_domain, dname, conf, event)
+					f = dpool.submit(
+						do_exec_domain,
+						dname,
+						conf,
+						event,
+						wildcard,
+						deadline)
 					fs.append(f)
 
 			while fs:
@@ -672,41 +1053,164 @@ def do_exec ():
 	finally:
 		fs_cancel_all(fs)
 
+# for the exit sweep
+init_started = False
+init_journal: TransactionJournal | None = None
+
+def close_journal_when_done (
+		journal: TransactionJournal,
+		fs: Iterable[futures.Future]):
+	'''
+	Close the journal once all the domains are done. The domains stuck past
+	the grace period still settle their holds when they get to it.
+	'''
+	left = [ f for f in fs if not f.done() ]
+	if not left:
+		journal.close()
+		return
+
+	lock = threading.Lock()
+	n = len(left)
+
+	def on_done (_):
+		nonlocal n
+		with lock:
+			n -= 1
+			if n:
+				return
+		journal.close()
+
+	for f in left:
+		f.add_done_callback(on_done)
+
+def replay_journals ():
+	'''
+	Roll back the holds left unsettled by the inits that did not get to finish
+	(killed). Only attempted once. The resources that fail to roll back are
+	left for the sweep.
+	'''
+	for path in TransactionJournal.find(run_param.state_dir):
+		try:
+			journal = TransactionJournal(path)
+		except BlockingIOError:
+			# the instance running it
+			continue
+		except OSError as e:
+			with stdout_lock:
+				ec2fleetd.pexcept(e, "Opening journal")
+			continue
+
+		with journal:
+			if journal.meta.get("instance_id") != ms.instance_id:
+				# carried over in the image the instance was launched from
+				journal.discard()
+				continue
+
+			t_logger = ResourceTransactionLogger()
+			t_logger.cbset.add(journal.log)
+			for seq, state in reversed(list(journal.pending.items())):
+				try:
+					rt = aws.restore_hold(aws_pool, state, t_logger)
+					journal.adopt(rt, seq)
+					rt.rollback()
+					journal.settle(rt, "rollback")
+				except Exception as e:
+					with stdout_lock:
+						ec2fleetd.pexcept(e, "Replaying " + path)
+			journal.discard()
+
+			ms.transaction_log = cap_transc_log(
+				ms.transaction_log + list(t_logger.logs))
+
+def open_journal () -> TransactionJournal | None:
+	try:
+		return TransactionJournal(
+			TransactionJournal.mk_path(run_param.state_dir, run_param.transc_id),
+			{
+				"transc_id": run_param.transc_id,
+				"instance_id": ms.instance_id,
+				"ts": datetime.datetime.now(datetime.UTC).isoformat()
+			})
+	except OSError as e:
+		# not worth failing the init for
+		with stdout_lock:
+			ec2fleetd.pexcept(e, "Journal disabled")
+
+	return None
+
 def do_init ():
 	if not run_param.enable_init:
 		return
 
+	global init_started, init_journal
 	failed_domains = set[str]()
 	fs = list[futures.Future]()
 
+	replay_journals()
+	journal = open_journal()
+	init_started = True
+	init_journal = journal
+	deadline = Deadline(init_timeout)
+
+	for dname, dconf in fleet_conf.get("domains", {}).items():
+		for r_spec in dconf.get("update-route53", []):
+			r53_batcher.expect(r_spec["hostedzone"], dname)
+
+	dpool = mk_dexecutor()
+	dnames = dict[futures.Future, str]()
 	try:
-		with mk_dexecutor() as dpool:
+		with dev_mon:
 			for dname, dconf in fleet_conf.get("domains", {}).items():
-				f = dpool.submit(do_domain_init, dname, dconf)
+				f = dpool.submit(do_domain_init, dname, dconf, deadline, journal)
 				fs.append(f)
+				dnames[f] = dname
 
 			try:
-				fs_wait_all(fs)
+				fs_wait_all(fs, deadline.remaining())
 			except TimeoutError:
-				# FIXME: never reached as the `fs_wait_all()` call is not timed.
+				# wake up the domains still waiting and give them some time to
+				# roll back
+				deadline.cancel()
+				try:
+					fs_wait_all(fs, magic.Code.ROLLBACK_GRACE)
+				except TimeoutError:
+					pass
+			except BaseException:
+				# interrupted. The domains must be done rolling back before the
+				# exit sweep looks for what's left of the transaction.
+				deadline.cancel()
 				fs_cancel_all(fs)
-				# TODO: send SIGALRM to the threads in the pool. No way to do that
-				# with python for now... Shoulda written this in C.
+				futures.wait(fs, magic.Code.ROLLBACK_GRACE)
+				raise
 
 			while fs:
 				r = fs.pop(0)
 
+				if not r.done():
+					failed_domains.add(dnames[r])
+					ms.error.append(
+						'''{dname}: timed out and failed to roll back in time'''
+						.format(dname = dnames[r]))
+					continue
+
 				result = r.result()
 				dname = result[0]
 				tlogs = result[1]
 				exc = result[2]
 
-				ms.transaction_log += tlogs
+				# rebind so that the views of other domains don't see the list grow
+				# under them
+				ms.transaction_log = cap_transc_log(ms.transaction_log + tlogs)
 				if exc:
 					failed_domains.add(dname)
 					ms.error.append(traceback.format_exception(exc))
 	finally:
-		fs_cancel_all(fs)
+		fs_cancel_all(list(dnames))
+		# don't wait for the domains still stuck after the grace period
+		dpool.shutdown(wait = False, cancel_futures = True)
+		if journal:
+			# kept if the holds of any domain are left unsettled
+			close_journal_when_done(journal, dnames.keys())
 
 	if failed_domains:
 		msg = '''Domain(s) failed: {dnames}'''.format(
@@ -714,7 +1218,11 @@ def do_init ():
 		with stdout_lock:
 			sys.stderr.write(msg + os.linesep)
 
-		raise DomainFailedError(failed_domains)
+		e = DomainFailedError(failed_domains)
+		if deadline.expired():
+			# the domains report the expiry as their own failures
+			raise TimeoutError("Init timed out") from e
+		raise e
 
 	hostname = fleet_conf.get("set-hostname")
 	if hostname:
@@ -727,27 +1235,53 @@ def do_init ():
 			with stdout_lock:
 				ec2fleetd.pexcept(e, "setting hostname")
 
-def mk_notify_backend (
-		session,
-		kind: str,
-		opts: dict[str, Any]) -> NotifyBackend:
+def mk_notify_backend (kind: str, opts: dict[str, Any]) -> NotifyBackend:
 	if "region" not in opts:
 		opts["region"] = ms.placement_region
 
 	match kind:
 		case "ans-sqs":
-			return aws.SQSNotifyBackend(session, opts)
+			return aws.SQSNotifyBackend(aws_pool, opts)
 		case "aws-sns":
-			return aws.SNSNotifyBackend(session, opts)
+			return aws.SNSNotifyBackend(aws_pool, opts)
+
+notify_backends = dict[str, NotifyBackend]()
+notify_backends_lock = threading.Lock()
+
+def get_notify_backend (kind: str, opts: dict[str, Any]) -> NotifyBackend:
+	'''One backend per distinct config, shared by all the domains'''
+	key = json.dumps([ kind, opts ], sort_keys = True)
+
+	with notify_backends_lock:
+		ret = notify_backends.get(key)
+		if ret is None:
+			ret = mk_notify_backend(kind, dict(opts))
+			notify_backends[key] = ret
+
+	return ret
+
+def on_notify_error (e: Exception):
+	# Notification failure is not critical by design
+	with stdout_lock:
+		ec2fleetd.pexcept(e, "sending notification")
 
-def do_notify_domain (dname: str, nlist: Iterable[dict[str, Any]]):
-	local_ms = deepcopy(ms)
+notifier = NotifyDispatcher(on_notify_error)
+
+def mk_notifications (
+		dname: str,
+		nlist: Iterable[dict[str, Any]],
+		event: str) -> list[tuple[NotifyBackend, str, str]]:
+	local_ms = ms.overlay()
 	local_ms.domain = dname
-	session = mk_profile()
+	local_ms.exec_results = exec_results.get(dname, [])
+	ret = list[tuple[NotifyBackend, str, str]]()
 
 	for conf in nlist:
 		matrix = conf.get("matrix", magic.Notify.Matrix.DEFAULT_MATRIX)
-		row = matrix.get(local_ms.daemon_state, magic.Notify.Matrix.DEFAULT_ROW)
+		if event in magic.Notify.Matrix.OPT_IN:
+			row = matrix.get(event, magic.Notify.Matrix.OFF_ROW)
+		else:
+			row = matrix.get(event, magic.Notify.Matrix.DEFAULT_ROW)
 		if not row.get("enabled"):
 			continue
 
@@ -759,56 +1293,122 @@ def do_notify_domain (dname: str, nlist: Iterable[dict[str, Any]]):
 			mail_subject = env.get("subject")
 			mail_body = env.get("body")
 
-		mail_subject = local_ms.format(mail_subject)
-		mail_body = local_ms.format(mail_body)
+		ret.append((
+			get_notify_backend(conf["backend"], conf.get("options", {})),
+			local_ms.format(mail_subject),
+			local_ms.format(mail_body) ))
 
-		agent = mk_notify_backend(
-			session,
-			conf["backend"],
-			conf.get("options", {}))
-		try:
-			agent.post(mail_subject, mail_body)
-		except Exception as e:
-			# Notification failure is not critical by design
-			with stdout_lock:
-				ec2fleetd.pexcept(e, "sending notification")
+	return ret
 
-def do_notify ():
+def do_notify (
+		event: str | None = None,
+		domains: Iterable[str] | None = None):
+	'''Queue the notifications of the `domains`(all if None). Sent in the
+	background by `notifier`.'''
 	if not run_param.enable_notify:
 		return
 
-	fs = list[futures.Future]()
+	if event is None:
+		event = ms.daemon_state
+	msgs = list[tuple[NotifyBackend, str, str]]()
 
-	try:
-		with mk_dexecutor() as dpool:
-			for dname, dconf in fleet_conf.get("domains", {}).items():
-				conf = dconf.get("notify")
-				if conf:
-					f = dpool.submit(do_notify_domain, dname, conf)
-					fs.append(f)
+	for dname, dconf in fleet_conf.get("domains", {}).items():
+		if domains is not None and dname not in domains:
+			continue
+		conf = dconf.get("notify")
+		if conf:
+			msgs.extend(mk_notifications(dname, conf, event))
 
-			while fs:
-				r = fs.pop(0)
-				r.result()
-	finally:
-		fs_cancel_all(fs)
+	notifier.dispatch(msgs)
 
-def do_poll () -> bool:
-	int_sched = None
-	try:
-		int_sched = mm.poll_int_sched()
-	except:
-		pass
-	if not int_sched or not int_sched.valid():
-		return True
+def flush_notify ():
+	'''Give the notifications a chance to go out before exit'''
+	timeout = magic.Code.NOTIFY_FLUSH_TIMEOUT
+	deadline = mk_interrupt_deadline()
+	if deadline is not None:
+		timeout = deadline.clamp(timeout)
+
+	if not notifier.wait(timeout):
+		with stdout_lock:
+			sys.stderr.write(
+				"Timed out sending notifications" + os.linesep)
+	notifier.shutdown()
+
+def on_poll_error (e: Exception, errors: int):
+	# report only the first error of the streak
+	if errors == 1:
+		with stdout_lock:
+			ec2fleetd.pexcept(e, "polling interruption notice")
+
+interrupt_time: datetime.datetime | None = None
 
-	ms.interrupt_time = int_sched.time().isoformat()
+def mk_interrupt_deadline () -> Deadline | None:
+	'''
+	The execs on interruption have to be done by the time of the interruption,
+	with some time left for the OS to shut down.
+	'''
+	if ms.daemon_state != DaemonState.INTERRUPTED or interrupt_time is None:
+		return None
+
+	left = (interrupt_time - datetime.datetime.now(datetime.UTC)).total_seconds()
+	return Deadline(max(0.0, left - magic.Code.INTERRUPT_MARGIN))
+
+def report_poll_stats (watcher: InterruptWatcher):
+	'''For confirming the cost of polling in the steady state'''
+	stats = { "polls": watcher.polls, "errors": watcher.errors }
+	stats.update(mm.counters())
+
+	with stdout_lock:
+		sys.stderr.write("Poll stats: " + " ".join(
+			'''{k}={v}'''.format(k = k, v = v) for k, v in stats.items()) +
+			os.linesep)
+
+def do_poll ():
+	watcher = InterruptWatcher(
+		mm,
+		PollSchedule.from_conf(fleet_conf.get("interrupt-detection")),
+		on_poll_error)
+	watcher.start()
+	try:
+		int_sched = watcher.wait()
+	finally:
+		watcher.stop()
+		report_poll_stats(watcher)
+
+	global interrupt_time
+	interrupt_time = int_sched.time()
+	if interrupt_time.tzinfo is None:
+		interrupt_time = interrupt_time.replace(tzinfo = datetime.UTC)
+	ms.interrupt_time = interrupt_time.isoformat()
 	ms.interrupt_action = int_sched.action()
 
 	with stdout_lock:
 		sys.stderr.write("SPOT INTERRUPTION NOTICE RECEIVED !!!" + os.linesep)
 		sys.stderr.write(str(int_sched) + os.linesep)
-	return False
+
+def on_dns_synced (elapsed: float, domains: set[str]):
+	'''Only the domains that made the changes get the event'''
+	ms.dns_sync_time = round(elapsed, 3)
+
+	with stdout_lock:
+		sys.stderr.write(
+			'''Route 53 changes in sync ({elapsed:.3f}s){nl}'''.format(
+				elapsed = elapsed,
+				nl = os.linesep))
+
+	try:
+		do_exec(DaemonEvent.DNS_SYNCED, domains = domains)
+	except Exception as e:
+		with stdout_lock:
+			ec2fleetd.pexcept(e, "running exec on " + DaemonEvent.DNS_SYNCED)
+	do_notify(DaemonEvent.DNS_SYNCED, domains)
+
+def on_dns_sync_error (e: Exception):
+	with stdout_lock:
+		ec2fleetd.pexcept(e, "Gave up waiting for Route 53 changes")
+
+r53_sync.on_synced = on_dns_synced
+r53_sync.on_error = on_dns_sync_error
 
 def report_ready ():
 	now = datetime.datetime.now(datetime.UTC)
@@ -818,43 +1418,96 @@ def report_ready ():
 		elapsed = elapsed.total_seconds())
 	sys.stderr.write(msg + os.linesep)
 
-# FIXME
-'''
-I messed up. It's difficult to send SIGALRM to the threads in a
-`ThreadPoolExecutor`.
-'''
-if fleet_conf.get("timeout") is not None:
-	sys.stderr.write(
-		'''"timeout" setting is currently ignored.''' + os.linesep)
+def report_startup_profile ():
+	extra = dict[str, float]()
+	if aws.sdk_load_time is not None:
+		extra["AWS SDK load"] = aws.sdk_load_time
+
+	with stdout_lock:
+		startup_prof.report(sys.stderr, extra)
+
+def save_state_cache ():
+	if not run_param.enable_init:
+		# nothing to save
+		return
+
+	try:
+		state_cache.save(
+			ms.instance_id,
+			config_hash,
+			{ k: getattr(ms, k) for k in mm.meta_fields() })
+	except OSError as e:
+		with stdout_lock:
+			ec2fleetd.pexcept(e, "Saving state cache")
+
+def stamp_used_vols ():
+	'''
+	The volumes are done being used(unmounted by the exec, hopefully). Stamp
+	them again for "most-recently-used" as the data on them is only as recent
+	as now.
+	'''
+	for get_client, vid in used_vols:
+		try:
+			aws.put_ts_used_tag(get_client(), [ vid ], None)
+		except Exception as e:
+			ec2fleetd.pexcept(e, "Stamping " + vid)
+
+def init_unsettled () -> bool:
+	'''Whether the init may have left anything behind'''
+	if not init_started:
+		return False
+	if init_journal is None:
+		# the journal is disabled. Can't tell
+		return True
+	return bool(init_journal.pending)
+
+def clean_up_transc () -> tuple[Iterable[ResourceTransactionLog], Exception]:
+	# only volumes are tagged for now
+	if init_unsettled() and any(
+			dconf.get("attach-volume")
+			for dconf in fleet_conf.get("domains", {}).values()):
+		return aws.clean_up_transc(
+			aws_pool,
+			ms.placement_region,
+			transc_id = run_param.transc_id)
+	return ( [], None )
 
 ec = EC.OK
 try:
 	init_start = datetime.datetime.now(datetime.UTC)
 	do_exec()
+	startup_prof.mark("exec (starting)")
 	do_init()
-	signal.alarm(0) # cancels alarm
+	save_state_cache()
+	startup_prof.mark("init")
 
 	ms.daemon_state = DaemonState.STARTED
 	do_exec()
+	startup_prof.mark("exec (started)")
 	report_ready()
 	do_notify()
+	startup_prof.mark("notify (started)")
 	sdn.notify("READY=1")
+	if run_param.startup_profile:
+		report_startup_profile()
+	r53_sync.start()
 
 	if run_param.enable_poll:
 		sdn.notify("STATUS=Polling interruption ...")
-		while do_poll():
-			time.sleep(magic.Code.POLL_INTERVAL)
+		do_poll()
 		ms.daemon_state = DaemonState.INTERRUPTED
 		sdn.notify("STATUS=SPOT INTERRUPTION NOTICE RECEIVED!!!")
 except InterruptedError:
 	sdn.notify("STATUS=Process interrupted")
 	ms.daemon_state = DaemonState.STOPPING
 except Exception as e:
-	if e is TimeoutError:
+	if isinstance(e, TimeoutError):
 		sdn.notify("STATUS=Init timed out")
 	else:
 		sdn.notify("STATUS=Daemon failed")
 	ms.error.append(traceback.format_exception(e))
+	# verify everything with the cloud next time
+	state_cache.remove()
 
 	ms.daemon_state = DaemonState.FAILED
 	ec = EC.GENERIC_ERR
@@ -863,15 +1516,28 @@ except Exception as e:
 finally:
 	sdn.notify("STOPPING=1")
 
-	result = aws.clean_up_transc(run_param.transc_id)
-	ms.transaction_log += result[0]
+	try:
+		do_exec(deadline = mk_interrupt_deadline())
+	except Exception as e:
+		# the notification must go out regardless
+		with stdout_lock:
+			ec2fleetd.pexcept(e, "running exec on " + ms.daemon_state)
+		ms.error.append(traceback.format_exception(e))
+		ec = EC.GENERIC_ERR
+
+	# after the exec so that it doesn't eat into the time before the
+	# interruption
+	result = clean_up_transc()
+	ms.transaction_log = cap_transc_log(ms.transaction_log + list(result[0]))
 	if result[1]:
 		ec2fleetd.pexcept(result[1], "Cleaning up transaction.")
 		sys.stderr.write(
 			"There should be some resources the daemon was unable to clean up" +
 			os.linesep)
-
-	do_exec()
 	do_notify()
 
-exit(EC.OK)
+	if ms.daemon_state in [ DaemonState.INTERRUPTED, DaemonState.STOPPING ]:
+		stamp_used_vols()
+	flush_notify()
+
+exit(ec)
@@ -1,15 +1,48 @@
+import copy
 import datetime
 import glob
+import http.client
 import io
 import json
+import os
+import random
+import re
+import socket
+import threading
 import time
 from abc import *
-from typing import Any, override
-
-import ec2imds
+from concurrent import futures
+from typing import Any, Callable, Iterator, override
 
 from ec2fleetd import *
 
+'''
+The AWS SDK and ec2imds are imported on first use. boto3 alone takes
+hundreds of milliseconds to import on small instances and not all configs
+need it.
+'''
+sdk_load_time: float | None = None
+
+def _load_sdk ():
+	global sdk_load_time
+
+	started = time.perf_counter()
+	import boto3
+	import botocore.config
+	import botocore.exceptions
+	if sdk_load_time is None:
+		sdk_load_time = time.perf_counter() - started
+
+	return boto3, botocore
+
+def __getattr__ (name: str):
+	match name:
+		case "ClientError":
+			return _load_sdk()[1].exceptions.ClientError
+
+	raise AttributeError(
+		'''module {m} has no attribute {name}'''.format(m = __name__, name = name))
+
 
 class Magic:
 	class TagName:
@@ -18,9 +51,58 @@ class Magic:
 		TS_USED = "user:ec2fd.ts-used"
 		POOL_NAME = "user:ec2fd.pool-name"
 		IN_TRANSIT = "user:ec2fd.in-transit"
+		TS_CLAIMED = "user:ec2fd.ts-claimed"
+		CLAIMED_BY = "user:ec2fd.claimed-by"
 	class Code:
 		EC2_VOL_CREATE_POLLWAIT_STEPS = [ 0.0, 1.0, 5.0, 5.0, 10.0 ]
 		EC2_VOL_DETACH_WAIT = 1.0
+		EC2_VOL_DETACH_TIMEOUT = 60.0
+		R53_INSYNC_POLLWAIT_STEPS = [ 1.0, 2.0, 4.0, 8.0, 10.0 ]
+		R53_INSYNC_TIMEOUT = 600.0 # usually in sync within a minute
+		R53_INSYNC_MAX_ERRORS = 5 # in a row
+		AWS_MAX_POOL_CONNECTIONS = 10 # botocore default
+		AWS_CONNECT_TIMEOUT = 10.0
+		AWS_READ_TIMEOUT = 30.0
+		R53_BATCH_LINGER = 1.0
+		# https://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DNSLimitations.html#limits-api-requests-changeresourcerecordsets
+		R53_BATCH_MAX_CHANGES = 1000
+		R53_BATCH_MAX_RRS = 1000
+		R53_BATCH_MAX_CHARS = 32000
+		READONLY_PREFIXES = ( "describe_", "list_", "get_" )
+		# (rate, burst) per process. Looked up by "service:read",
+		# "service:write" then "service". Not limited if none matches.
+		# https://docs.aws.amazon.com/ec2/latest/devguide/ec2-api-throttling.html
+		# https://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DNSLimitations.html#limits-api-requests
+		AWS_RATE_LIMITS = {
+			"ec2:read": ( 10.0, 20 ),
+			"ec2:write": ( 2.0, 10 ),
+			"route53": ( 5.0, 5 )
+		}
+		AWS_RETRY_MAX = 8
+		AWS_RETRY_BASE = 0.5
+		AWS_RETRY_CAP = 20.0
+		AWS_THROTTLE_CODES = (
+			"Throttling",
+			"ThrottlingException",
+			"RequestLimitExceeded",
+			"TooManyRequestsException",
+			"PriorRequestNotComplete" # Route 53
+		)
+		# sorts before any "ts-used"
+		TS_NEVER = datetime.datetime.min.replace(tzinfo = datetime.UTC)
+		EC2_VOL_PAGE_SIZE = 100
+		R53_RR_PAGE_SIZE = "16" # the API takes a string
+		# https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/quotas-messages.html
+		SQS_BATCH_MAX = 10
+		SQS_BATCH_MAX_BYTES = 262144 # 256KiB, all the messages combined
+		SWEEP_CONCURRENCY = 4
+		SWEEP_PAGE_SIZE = 500
+		IMDS_TIMEOUT = 5.0
+		IMDS_CONNECT_TIMEOUT = 1.0
+		IMDS_TRIES = 3 # in a row without progress
+		IMDS_TOKEN_TTL = 21600 # 6 hours, the max
+		IMDS_TOKEN_REFRESH = 60 # refreshed this many seconds before expiry
+		IMDS_TOKEN_RETRY = 5.0
 
 
 class EC2VolumeCreatePollWaitStep:
@@ -64,6 +146,269 @@ class EC2InterruptSchedule (InterruptSchedule):
 	def valid (self) -> bool:
 		return datetime.datetime.now(datetime.UTC) <= self._time
 
+class _PipelineReader:
+	'''Hands the same buffered reader to each `http.client.HTTPResponse` so
+	that the pipelined responses are read one after another. Closing a
+	response must not close the connection.'''
+	def __init__ (self, fp: io.BufferedReader):
+		self.fp = fp
+
+	def makefile (self, *args, **kwargs):
+		return self
+
+	def close (self):
+		pass
+
+	def __getattr__ (self, name: str):
+		return getattr(self.fp, name)
+
+class IMDSSession:
+	'''
+	A long-lived IMDSv2 session: one keep-alive HTTP/1.1 connection and the
+	session token, refreshed in the background shortly before it expires. In
+	the steady state, a `get()` is exactly one GET on the same connection.
+
+	The requests of `get_many()` are pipelined: all sent at once and the
+	responses read in order, so that the round trips overlap on the one
+	connection. Pipelining is turned off for the session if the server closes
+	the connection or fails to answer in the middle of a batch.
+
+	`requests`, `reconnects` and `token_refreshes` count the requests sent,
+	the connections made after the first and the tokens fetched.
+	'''
+
+	def __init__ (
+			self,
+			endpoints: list[tuple[str, int | None]],
+			token_ttl: int = Magic.Code.IMDS_TOKEN_TTL,
+			timeout: float = Magic.Code.IMDS_TIMEOUT):
+		self.requests = 0
+		self.reconnects = 0
+		self.token_refreshes = 0
+		self._endpoints = list(endpoints)
+		self._token_ttl = token_ttl
+		self._timeout = timeout
+		self._sock: socket.socket | None = None
+		self._reader: _PipelineReader | None = None
+		self._host: str | None = None
+		self._connected = False
+		# cleared if the server closes the connection after a response or
+		# fails to answer the pipelined requests
+		self._pipeline = True
+		self._token: str | None = None
+		self._token_expiry = 0.0 # monotonic
+		self._lock = threading.Lock()
+		self._closed = threading.Event()
+		self._th: threading.Thread | None = None
+
+	def counters (self) -> dict[str, int]:
+		return {
+			"requests": self.requests,
+			"reconnects": self.reconnects,
+			"token_refreshes": self.token_refreshes
+		}
+
+	def close (self):
+		self._closed.set()
+		with self._lock:
+			self._disconnect()
+
+	def _disconnect (self):
+		if self._sock:
+			self._reader.fp.close()
+			self._sock.close()
+		self._sock = None
+		self._reader = None
+
+	def _connect (self):
+		saved = None
+		# the one that worked last time first
+		for ep in list(self._endpoints):
+			addr = ( ep[0], ep[1] or 80 )
+			try:
+				sock = socket.create_connection(
+					addr,
+					Magic.Code.IMDS_CONNECT_TIMEOUT)
+			except OSError as e:
+				saved = e
+				continue
+
+			sock.settimeout(self._timeout)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self._endpoints.remove(ep)
+			self._endpoints.insert(0, ep)
+			if ':' in addr[0]:
+				self._host = '''[{h}]:{p}'''.format(h = addr[0], p = addr[1])
+			else:
+				self._host = '''{h}:{p}'''.format(h = addr[0], p = addr[1])
+			self._sock = sock
+			self._reader = _PipelineReader(sock.makefile("rb"))
+
+			if self._connected:
+				self.reconnects += 1
+			self._connected = True
+			return
+
+		raise saved or ConnectionError("no IMDS endpoint")
+
+	def _mk_request (
+			self,
+			method: str,
+			path: str,
+			headers: dict[str, Any]) -> bytes:
+		lines = [ '''{m} /latest/{path} HTTP/1.1'''.format(m = method, path = path) ]
+		lines.append("Host: " + self._host)
+		for k, v in headers.items():
+			lines.append('''{k}: {v}'''.format(k = k, v = v))
+		lines.append("")
+		lines.append("")
+
+		return "\r\n".join(lines).encode()
+
+	def _send (self, reqs: list[bytes]):
+		self._sock.sendall(b''.join(reqs))
+		self.requests += len(reqs)
+
+	def _read (self) -> tuple[int, bytes]:
+		rsp = http.client.HTTPResponse(self._reader)
+		rsp.begin()
+		body = rsp.read()
+		if rsp.will_close:
+			# the rest are not going to be answered. Don't pipeline from now on
+			self._pipeline = False
+			self._disconnect()
+
+		return ( rsp.status, body )
+
+	def _put_token (self):
+		if self._sock is None:
+			self._connect()
+
+		sent = time.monotonic()
+		self._send([ self._mk_request(
+			"PUT",
+			"api/token",
+			{
+				"X-aws-ec2-metadata-token-ttl-seconds": self._token_ttl,
+				"Content-Length": 0
+			}) ])
+		status, body = self._read()
+		if status != 200:
+			raise http.client.HTTPException(
+				'''api/token: HTTP {status}'''.format(status = status))
+
+		self._token = body.decode()
+		self._token_expiry = sent + self._token_ttl
+		self.token_refreshes += 1
+
+		if self._th is None:
+			self._th = threading.Thread(
+				target = self._refresh_main,
+				name = "imds-token",
+				daemon = True)
+			self._th.start()
+
+	def _token_due (self, margin: float) -> bool:
+		return (
+			self._token is None or
+			time.monotonic() >= self._token_expiry - margin)
+
+	def _refresh_main (self):
+		delay = 0.0
+		while not self._closed.wait(delay):
+			with self._lock:
+				try:
+					if self._token_due(Magic.Code.IMDS_TOKEN_REFRESH):
+						self._put_token()
+				except (OSError, http.client.HTTPException):
+					# the requests will get one if this keeps failing
+					self._disconnect()
+					delay = Magic.Code.IMDS_TOKEN_RETRY
+					continue
+
+				delay = max(
+					Magic.Code.IMDS_TOKEN_RETRY,
+					self._token_expiry - Magic.Code.IMDS_TOKEN_REFRESH -
+						time.monotonic())
+
+	def _round (
+			self,
+			paths: list[str],
+			pending: list[int],
+			ret: list[str | None]):
+		'''Send the pending requests and read the responses. The ones done are
+		removed from `pending`'''
+		if self._token_due(0):
+			self._put_token()
+		if self._sock is None:
+			self._connect()
+
+		hdr = { "X-aws-ec2-metadata-token": self._token }
+		batch = pending if self._pipeline else pending[:1]
+		self._send([ self._mk_request("GET", paths[i], hdr) for i in batch ])
+
+		for i in list(batch):
+			try:
+				status, body = self._read()
+			except (OSError, http.client.HTTPException):
+				if len(batch) > 1:
+					# timed out or cut short in the middle of the batch. Every
+					# batch would pay the timeout if this went on
+					self._pipeline = False
+				raise
+
+			match status:
+				case 200:
+					ret[i] = body.decode()
+					pending.remove(i)
+				case 404:
+					pending.remove(i)
+				case 401:
+					# expired while the instance was hibernated, or the
+					# leftover token from the image
+					self._token = None
+				case _:
+					raise http.client.HTTPException(
+						'''{path}: HTTP {status}'''.format(
+							path = paths[i],
+							status = status))
+
+			if self._sock is None:
+				break
+
+	def get_many (self, paths: list[str]) -> list[str | None]:
+		'''The values of the paths. None for the ones not found'''
+		ret = list[str | None]([ None ] * len(paths))
+		pending = list(range(len(paths)))
+		tries = 0
+
+		with self._lock:
+			while pending:
+				n = len(pending)
+				try:
+					self._round(paths, pending, ret)
+				except (OSError, http.client.HTTPException):
+					# including the keep-alive connection closed while idle
+					self._disconnect()
+					if len(pending) == n:
+						tries += 1
+						if tries >= Magic.Code.IMDS_TRIES:
+							raise
+					continue
+
+				if len(pending) < n:
+					tries = 0
+				else:
+					tries += 1
+					if tries >= Magic.Code.IMDS_TRIES:
+						raise http.client.HTTPException(
+							paths[pending[0]] + ": unauthorized")
+
+		return ret
+
+	def get (self, path: str) -> str | None:
+		return self.get_many([ path ])[0]
+
 class EC2MetaManager (MetaManager):
 	def extract_ip_addresses (mo, ipv_name: str) -> Iterable[str] | None:
 		try:
@@ -86,31 +431,107 @@ class EC2MetaManager (MetaManager):
 		ms.public_ipv4_list = EC2MetaManager.extract_ip_addresses(mo, "public-ipv4s")
 		ms.public_ipv6_list = EC2MetaManager.extract_ip_addresses(mo, "ipv6s")
 
+	MACS_KEY = "meta-data/network/interfaces/macs"
+	# the keys read by `update_macroset()` for each field
+	META_KEYS = {
+		"instance_id": [ "meta-data/instance-id" ],
+		"instance_type": [ "meta-data/instance-type" ],
+		"instance_index": [ "meta-data/ami-launch-index" ],
+		"placement_region": [ "meta-data/placement/region" ],
+		"placement_zone": [ "meta-data/placement/availability-zone" ],
+		"hypervisor": [ "meta-data/system" ],
+		"primary_public_ipv4": [ "meta-data/public-ipv4" ],
+		"primary_public_ipv6": [ "meta-data/ipv6" ],
+		"public_ipv4_list": [ MACS_KEY ],
+		"public_ipv6_list": [ MACS_KEY ],
+	}
+	MAC_KEYS = [ "public-ipv4s", "ipv6s" ]
 
 	def __init__ (self, imds: str | None = None):
+		import ec2imds
+
 		if imds:
 			imds_endpoints = ec2imds.IMDSWrapper.mk_endpoint_list_from_str(imds)
 		else:
 			imds_endpoints = ec2imds.IMDSAPIMagic.endpoints
 
+		# only for the full crawl
 		self._imds = ec2imds.IMDSWrapper(imds_endpoints)
-		# The token callbacks are not set because the daemon is long-lived
+		self.session = IMDSSession(imds_endpoints)
+
+	def _fetch_keys (self, fields: Iterable[str]) -> dict[str, Any]:
+		'''The same as the crawl as far as `update_macroset()` is concerned, but
+		only the keys for `fields` are fetched'''
+		ret = dict[str, Any]()
+		for keys in EC2MetaManager.META_KEYS.values():
+			for k in keys:
+				ret[k] = None
+
+		keys = sorted(set(
+			k for f in fields for k in EC2MetaManager.META_KEYS[f]))
+		for k, v in zip(keys, self.session.get_many(keys)):
+			ret[k] = v
+
+		if ret["meta-data/ami-launch-index"] is not None:
+			ret["meta-data/ami-launch-index"] = int(
+				ret["meta-data/ami-launch-index"])
+
+		# not there at all unless fetched, as `update_macroset()` expects
+		macs = ret.pop(EC2MetaManager.MACS_KEY)
+		if macs is not None:
+			# the addresses of all interfaces in one go
+			macs = [ m.rstrip('/') for m in macs.split('\n') if m ]
+			paths = [
+				'''{p}/{mac}/{k}'''.format(
+					p = EC2MetaManager.MACS_KEY,
+					mac = m,
+					k = k)
+				for m in macs
+				for k in EC2MetaManager.MAC_KEYS ]
+			values = iter(self.session.get_many(paths))
+
+			tree = dict[str, dict[str, list[str] | None]]()
+			for m in macs:
+				tree[m] = dict[str, list[str] | None]()
+				for k in EC2MetaManager.MAC_KEYS:
+					v = next(values)
+					tree[m][k] = v.split('\n') if v is not None else None
+			ret[EC2MetaManager.MACS_KEY] = tree
+
+		return ret
 
-	def fetch_meta (self, ms: MacroSet):
-		ret = self._imds.all()
+	def fetch_meta (self, ms: MacroSet, fields: Iterable[str] | None = None):
+		'''Only the keys for `fields` if given. The whole tree is crawled
+		otherwise'''
+		if fields is None:
+			ret = self._imds.all()
+		else:
+			ret = self._fetch_keys(fields)
 		EC2MetaManager.update_macroset(ret, ms)
 		return ret
 
-	def open_userdata (self) -> io.BufferedIOBase:
-		ret = self._imds.open_userdata()
+	def verify_meta (self, ms: MacroSet) -> bool:
+		# the addresses may change without a reboot(elastic IP)
+		return self.session.get_many([
+				"meta-data/instance-id",
+				"meta-data/public-ipv4",
+				"meta-data/ipv6" ]) == [
+			ms.instance_id,
+			ms.primary_public_ipv4,
+			ms.primary_public_ipv6 ]
 
-		if ret is None:
-			return io.BytesIO()
-		return ret
+	def meta_fields (self) -> Iterable[str]:
+		return EC2MetaManager.META_KEYS.keys()
+
+	def open_userdata (self) -> io.TextIOBase:
+		return io.StringIO(self.session.get("user-data") or "")
 
 	def poll_int_sched (self) -> InterruptSchedule:
-		obj = self._imds.dir_dict["meta-data/spot/instance-action"].func()
-		return EC2InterruptSchedule(obj)
+		doc = self.session.get("meta-data/spot/instance-action")
+		return EC2InterruptSchedule(json.loads(doc) if doc is not None else None)
+
+	def counters (self) -> dict[str, int]:
+		return self.session.counters()
 
 class AWSResourceTranscLog (ResourceTransactionLog):
 	def __init__ (
@@ -118,21 +539,19 @@ class AWSResourceTranscLog (ResourceTransactionLog):
 			domain: str,
 			method: str,
 			param: dict[str, Any],
-			dry: bool = False):
+			dry: bool = False,
+			attempt: int = 0,
+			error: str | None = None):
 		self._domain = domain
 		self._method = method
 		self._param = param
 		self._dry = dry
+		self._attempt = attempt
+		self._error = error
 
 	@override
 	def __repr__ (self) -> str:
-		return str({
-			"platform": "aws",
-			"domain": self._domain,
-			"method": self._method,
-			"param": self._param,
-			"dry": self._dry
-		})
+		return str(self.dict())
 
 	def dict (self) -> dict:
 		return {
@@ -140,20 +559,232 @@ class AWSResourceTranscLog (ResourceTransactionLog):
 			"domain": self._domain,
 			"method": self._method,
 			"param": self._param,
-			"dry": self._dry
+			"dry": self._dry,
+			# retry count and the error that caused the retry
+			"attempt": self._attempt,
+			"error": self._error
 		}
 
 	def dry (self) -> bool:
 		return self._dry
 
+def get_tag (res: dict[str, Any], key: str) -> str | None:
+	for tag in res.get("Tags", []):
+		if tag.get("Key") == key:
+			return tag.get("Value")
+
+class CallCoalescer:
+	'''Single-flight for read-only API calls. Concurrent calls with identical
+	parameters in the same scope(service and region) are served by one request.
+	Only the calls in flight are shared: the ones made after the request is
+	done get a fresh result, so the poll loops see the changes. The calls made
+	after the daemon performs a write in the scope are not joined with the ones
+	made before.'''
+
+	def __init__ (self):
+		self._lock = threading.Lock()
+		self._gen = dict[tuple, int]()
+		self._inflight = dict[tuple, futures.Future]()
+
+	def readonly (fname: str) -> bool:
+		return fname.startswith(Magic.Code.READONLY_PREFIXES)
+
+	def invalidate (self, scope: tuple):
+		with self._lock:
+			self._gen[scope] = self._gen.get(scope, 0) + 1
+
+	def call (
+			self,
+			scope: tuple,
+			fname: str,
+			f: Callable[..., Any],
+			kwargs: dict[str, Any]) -> Any:
+		param = json.dumps(kwargs, sort_keys = True, default = str)
+
+		with self._lock:
+			gen = self._gen.get(scope, 0)
+			key = ( scope, gen, fname, param )
+
+			fut = self._inflight.get(key)
+			owner = fut is None
+			if owner:
+				fut = futures.Future()
+				self._inflight[key] = fut
+
+		if not owner:
+			return copy.deepcopy(fut.result())
+
+		try:
+			ret = f(**kwargs)
+		except BaseException as e:
+			with self._lock:
+				del self._inflight[key]
+			fut.set_exception(e)
+			raise
+
+		with self._lock:
+			del self._inflight[key]
+		fut.set_result(ret)
+
+		return copy.deepcopy(ret)
+
+coalescer = CallCoalescer()
+
+class RateLimiter:
+	'''Process-wide token buckets per API family and region. A throttled
+	call slows down all the calls in the same family.'''
+
+	def __init__ (
+			self,
+			limits: dict[str, tuple[float, float]] = Magic.Code.AWS_RATE_LIMITS):
+		self._limits = dict(limits)
+		self._lock = threading.Lock()
+		self._buckets = dict[tuple[str, str | None], TokenBucket | None]()
+
+	def configure (self, conf: dict[str, dict[str, float] | None]):
+		'''Override the limits. null to lift the limit of the family.'''
+		with self._lock:
+			for k, v in conf.items():
+				if v is None:
+					self._limits[k] = None
+				else:
+					self._limits[k] = ( v["rate"], v.get("burst", v["rate"]) )
+			self._buckets.clear()
+
+	def bucket (
+			self,
+			service: str,
+			region: str | None,
+			fname: str) -> TokenBucket | None:
+		kind = "read" if CallCoalescer.readonly(fname) else "write"
+
+		with self._lock:
+			for family in [ service + ':' + kind, service ]:
+				if family not in self._limits:
+					continue
+
+				key = ( family, region )
+				if key not in self._buckets:
+					l = self._limits[family]
+					self._buckets[key] = TokenBucket(*l) if l else None
+				return self._buckets[key]
+
+		return None
+
+rate_limiter = RateLimiter()
+
 class BotoClientWrapper:
-	def __init__ (self, client, domain: str):
+	def __init__ (
+			self,
+			client,
+			domain: str,
+			coalescer: CallCoalescer | None = coalescer,
+			limiter: RateLimiter | None = rate_limiter,
+			deadline: Deadline | None = None):
 		self.client = client
+		# bounds the retries and the waits for the rate limiter. Replaceable
+		# so that the rollback gets its own time after the init deadline
+		self.deadline = deadline
 		self._domain = domain
-
-	def do_call (self, fname: str, logger: ResourceTransactionLogger, **kwargs):
+		self._coalescer = coalescer
+		self._limiter = limiter
+		self._scope = (
+			client.meta.service_model.service_name,
+			client.meta.region_name)
+
+	@property
+	def domain (self) -> str:
+		return self._domain
+
+	@property
+	def region (self) -> str | None:
+		return self._scope[1]
+
+	def _retry_reason (self, e: Exception) -> str | None:
+		'''The error code if the call should be retried'''
+		ClientError = _load_sdk()[1].exceptions.ClientError
+		ConnectionError = _load_sdk()[1].exceptions.ConnectionError
+
+		if isinstance(e, ClientError):
+			err = e.response.get("Error", {}).get("Code")
+			status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+			if err in Magic.Code.AWS_THROTTLE_CODES:
+				return err
+			if status and status >= 500:
+				return err or str(status)
+		elif isinstance(e, ConnectionError):
+			# never got to the endpoint. Safe to retry
+			return type(e).__name__
+
+		return None
+
+	def _invoke (
+			self,
+			fname: str,
+			logger: ResourceTransactionLogger,
+			kwargs: dict[str, Any]):
+		'''
+		Rate limited call with retries. The retries are done here rather than
+		by botocore so that the backoff is shared by all the threads and each
+		retry is logged. The retries stop once `deadline` can't cover the next
+		backoff.
+		'''
 		f = getattr(self.client, fname)
+		bucket = None
+		if self._limiter:
+			bucket = self._limiter.bucket(*self._scope, fname)
+
+		attempt = 0
+		while True:
+			if bucket:
+				bucket.acquire(self.deadline)
+
+			try:
+				ret = f(**kwargs)
+			except Exception as e:
+				reason = self._retry_reason(e)
+				if reason is None or attempt >= Magic.Code.AWS_RETRY_MAX:
+					raise
+
+				# full jitter
+				backoff = random.uniform(
+					0,
+					min(
+						Magic.Code.AWS_RETRY_CAP,
+						Magic.Code.AWS_RETRY_BASE * 2 ** attempt))
+				throttled = bucket and reason in Magic.Code.AWS_THROTTLE_CODES
+				if throttled:
+					# the others back off too
+					bucket.throttle(backoff)
+				if (self.deadline is not None and
+						self.deadline.clamp(backoff) < backoff):
+					raise
+
+				attempt += 1
+				# before the backoff so that the wait shows in the log
+				if logger:
+					logger.publish([ AWSResourceTranscLog(
+						self._domain,
+						fname,
+						kwargs,
+						kwargs.get("DryRun", False),
+						attempt,
+						reason) ])
+
+				if throttled:
+					# waited out in acquire()
+					pass
+				elif self.deadline is None:
+					time.sleep(backoff)
+				else:
+					self.deadline.sleep(backoff)
+				continue
+
+			if bucket:
+				bucket.relax()
+			return ret
 
+	def do_call (self, fname: str, logger: ResourceTransactionLogger, **kwargs):
 		log = AWSResourceTranscLog(
 			self._domain,
 			fname,
@@ -162,9 +793,49 @@ class BotoClientWrapper:
 		if logger:
 			logger.publish([ log ])
 
-		return f(**kwargs)
+		def f (**kwargs):
+			return self._invoke(fname, logger, kwargs)
 
-def _find_blockdev_by_vid_linux (vid) -> str | None:
+		if self._coalescer is None:
+			return f(**kwargs)
+		if CallCoalescer.readonly(fname):
+			return self._coalescer.call(self._scope, fname, f, kwargs)
+
+		try:
+			return f(**kwargs)
+		finally:
+			self._coalescer.invalidate(self._scope)
+
+	def do_paginate (
+			self,
+			fname: str,
+			logger: ResourceTransactionLogger,
+			**kwargs) -> Iterator[dict[str, Any]]:
+		'''
+		Yield the response of each page. The next page is requested only when
+		the iteration gets to it, so breaking out of the loop early saves the
+		rest of the calls. Handles both the EC2 style(`NextToken`) and the
+		Route 53 style(`IsTruncated` and `NextRecord*`) of pagination.
+		'''
+		kwargs = dict(kwargs)
+		while True:
+			rsp = self.do_call(fname, logger, **kwargs)
+			yield rsp
+
+			if rsp.get("NextToken"):
+				kwargs["NextToken"] = rsp["NextToken"]
+			elif rsp.get("IsTruncated"):
+				for k in [ "Name", "Type", "Identifier" ]:
+					kwargs.pop("StartRecord" + k, None)
+					if rsp.get("NextRecord" + k):
+						kwargs["StartRecord" + k] = rsp["NextRecord" + k]
+			else:
+				break
+
+def _norm_serial (s: str) -> str:
+	return str(s).strip().replace('-', '')
+
+class BlockDeviceIndex:
 	'''
 	https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/nvme-ebs-volumes.html
 
@@ -178,20 +849,94 @@ def _find_blockdev_by_vid_linux (vid) -> str | None:
 	Unlike NVMe volumes on Nitro, Xen drives do not expose their the volume id
 	to the instance, so a bit of trial and error to figure out how your
 	particular Linux distro or instance type to which you're trying to deploy
-	behaves may be required.
+	behaves may be required. The Xen block devices attached as /dev/sdX usually
+	show up as /dev/xvdX, so both names are indexed.
 
 	https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/device_naming.html
 	https://docs.aws.amazon.com/AWSEC2/latest/UserGuide/virtualization_types.html
+
+	The index is rebuilt when invalidated(on uevents) or when the listing of
+	/sys/block changes so that the threads waiting for devices share one scan.
 	'''
-	left = "/sys/block/"
-	right = "/device/serial"
-	dev_serials = glob.glob(left + "*" + right)
-	vid = str(vid).replace('-', '')
 
-	for path in dev_serials:
-		with open(path) as f:
-			if f.read().strip() == vid:
-				return "/dev/" + path[len(left):][:-len(right)]
+	class RE:
+		XEN_NAME = re.compile('''^(?:xv|s)d([a-z]+)$''')
+
+	def __init__ (self, sysfs: str = "/sys/block/", devfs: str = "/dev/"):
+		self._lock = threading.Lock()
+		self._sysfs = sysfs
+		self._devfs = devfs
+		self._valid = False
+		self._listing: frozenset[str] | None = None
+		self._by_serial = dict[str, str]()
+		self._by_name = dict[str, str]()
+
+	def invalidate (self, *args):
+		'''Can be used as a `UEventMonitor` callback'''
+		self._valid = False
+
+	def _read_serial (self, name: str) -> str | None:
+		try:
+			with open(self._sysfs + name + "/device/serial") as f:
+				return f.read()
+		except OSError:
+			return None
+
+	def _update (self):
+		listing = frozenset(os.listdir(self._sysfs))
+		if self._valid and listing == self._listing:
+			return
+
+		valid = True
+		by_serial = dict[str, str]()
+		by_name = dict[str, str]()
+		for name in listing:
+			serial = self._read_serial(name)
+			if serial is not None:
+				serial = _norm_serial(serial)
+			if serial:
+				by_serial[serial] = name
+			elif name.startswith("nvme"):
+				# the attribute is not populated yet. Try again next time.
+				valid = False
+
+			by_name[name] = name
+			m = BlockDeviceIndex.RE.XEN_NAME.match(name)
+			if m:
+				for alias in [ "xvd" + m[1], "sd" + m[1] ]:
+					by_name.setdefault(alias, name)
+
+		self._by_serial = by_serial
+		self._by_name = by_name
+		self._listing = listing
+		self._valid = valid
+
+	def _to_path (self, name: str | None) -> str | None:
+		if name is None:
+			return None
+		ret = self._devfs + name
+		# sysfs entry may precede the device node
+		if os.path.exists(ret):
+			return ret
+
+	def by_serial (self, serial: str) -> str | None:
+		with self._lock:
+			self._update()
+			return self._to_path(self._by_serial.get(_norm_serial(serial)))
+
+	def by_path (self, path: str) -> str | None:
+		if not path.startswith(self._devfs):
+			return None
+
+		with self._lock:
+			self._update()
+			return self._to_path(self._by_name.get(path[len(self._devfs):]))
+
+blockdev_index = BlockDeviceIndex()
+
+def _find_blockdev_by_vid_linux (vid) -> str | None:
+	'''See `BlockDeviceIndex`'''
+	return blockdev_index.by_serial(vid)
 
 def _find_blockdev_by_vid_win (*args) -> str | None:
 	raise NotImplementedError(
@@ -200,16 +945,29 @@ def _find_blockdev_by_vid_win (*args) -> str | None:
 def _find_blockdev_by_vid_unknown (*args) -> str | None:
 	raise NotImplementedError("Function not implemented for: " + sys.platform)
 
+def _find_blockdev_by_path_linux (path: str) -> str | None:
+	return blockdev_index.by_path(path) or _find_blockdev_by_path_glob(path)
+
+def _find_blockdev_by_path_glob (path: str) -> str | None:
+	if glob.glob(path):
+		return path
+
 if sys.platform.startswith("linux"):
 	_find_blockdev_by_vid_f = _find_blockdev_by_vid_linux
+	_find_blockdev_by_path_f = _find_blockdev_by_path_linux
 elif sys.platform.startswith("win"):
 	_find_blockdev_by_vid_f = _find_blockdev_by_vid_win
+	_find_blockdev_by_path_f = _find_blockdev_by_path_glob
 else:
 	_find_blockdev_by_vid_f = _find_blockdev_by_vid_unknown
+	_find_blockdev_by_path_f = _find_blockdev_by_path_glob
 
 def find_blockdev_by_vid (vid) -> str | None:
 	return _find_blockdev_by_vid_f(vid)
 
+def find_blockdev_by_path (path: str) -> str | None:
+	return _find_blockdev_by_path_f(path)
+
 def add_extra_tags (
 		extra_tags: Iterable[dict[str, Any]],
 		rtype: str,
@@ -231,8 +989,58 @@ def put_transc_tag (
 		c: BotoClientWrapper,
 		id: str,
 		transc_id: str,
+		logger: ResourceTransactionLogger,
+		instance_id: str | None = None):
+	tags = [
+		{
+			"Key": Magic.TagName.TRANSC_ID,
+			"Value": transc_id
+		}
+	]
+	if instance_id:
+		tags.append({
+			"Key": Magic.TagName.CLAIMED_BY,
+			"Value": instance_id
+		})
+
+	return c.do_call(
+		"create_tags",
+		logger,
+		Resources = [ id ],
+		Tags = tags)
+
+def delete_transc_tag (
+		c: BotoClientWrapper,
+		id: str,
 		logger: ResourceTransactionLogger):
 	return c.do_call(
+		"delete_tags",
+		logger,
+		Resources = [ id ],
+		Tags = [
+			{ "Key": Magic.TagName.TRANSC_ID },
+			{ "Key": Magic.TagName.IN_TRANSIT },
+			{ "Key": Magic.TagName.TS_CLAIMED },
+			{ "Key": Magic.TagName.CLAIMED_BY }
+		])
+
+def claim_vol (
+		c: BotoClientWrapper,
+		id: str,
+		transc_id: str,
+		instance_id: str,
+		logger: ResourceTransactionLogger) -> bool:
+	'''
+	Claim an available volume for the transaction before attaching it, so that
+	the instances racing for the same volume find out with two cheap calls
+	rather than by failing to attach. The last one to tag the volume wins.
+	The claim is released with `release_vol()`.
+
+	A lost claim is released before returning so that our tags don't lead
+	`clean_up_transc()` to the volume someone else is using.
+	'''
+	now = datetime.datetime.now(datetime.UTC)
+	c.do_call(
 		"create_tags",
 		logger,
 		Resources = [ id ],
@@ -240,20 +1048,78 @@ def put_transc_tag (
 			{
 				"Key": Magic.TagName.TRANSC_ID,
 				"Value": transc_id
+			},
+			{
+				"Key": Magic.TagName.TS_CLAIMED,
+				"Value": now.isoformat(timespec = "seconds")
+			},
+			{
+				"Key": Magic.TagName.CLAIMED_BY,
+				"Value": instance_id
 			}
 		])
 
-def delete_transc_tag (
+	try:
+		vols = c.do_call(
+			"describe_volumes",
+			logger,
+			VolumeIds = [ id ])["Volumes"]
+	except Exception:
+		release_vol(c, id, transc_id, instance_id, logger)
+		raise
+
+	if (vols and
+			vols[0]["State"] == "available" and
+			get_tag(vols[0], Magic.TagName.TRANSC_ID) == transc_id):
+		return True
+
+	release_vol(c, id, transc_id, instance_id, logger)
+	return False
+
+def get_ts_used (res: dict[str, Any]) -> datetime.datetime | None:
+	'''The time the resource was last used. None if never used or the tag is
+	malformed.'''
+	v = get_tag(res, Magic.TagName.TS_USED)
+	if not v:
+		return None
+	try:
+		ret = datetime.datetime.fromisoformat(v)
+	except ValueError:
+		return None
+	if ret.tzinfo is None:
+		ret = ret.replace(tzinfo = datetime.UTC)
+	return ret
+
+def put_ts_used_tag (
+		c: BotoClientWrapper,
+		ids: Iterable[str],
+		logger: ResourceTransactionLogger):
+	now = datetime.datetime.now(datetime.UTC)
+	return c.do_call(
+		"create_tags",
+		logger,
+		Resources = list(ids),
+		Tags = [
+			{
+				"Key": Magic.TagName.TS_USED,
+				"Value": now.isoformat(timespec = "seconds")
+			}
+		])
+
+def release_vol (
 		c: BotoClientWrapper,
 		id: str,
+		transc_id: str,
+		instance_id: str,
 		logger: ResourceTransactionLogger):
+	# only if it's still ours. The value must be given for that
 	return c.do_call(
 		"delete_tags",
 		logger,
 		Resources = [ id ],
 		Tags = [
-			{ "Key": Magic.TagName.TRANSC_ID },
-			{ "Key": Magic.TagName.IN_TRANSIT }
+			{ "Key": Magic.TagName.TRANSC_ID, "Value": transc_id },
+			{ "Key": Magic.TagName.CLAIMED_BY, "Value": instance_id }
 		])
 
 class EC2CreatedVolumeHold (ResourceHold):
@@ -266,6 +1132,14 @@ class EC2CreatedVolumeHold (ResourceHold):
 		self._id = id
 		self._logger = logger
 
+	def state (self) -> dict[str, Any]:
+		return {
+			"type": "ec2-created-volume",
+			"domain": self._c.domain,
+			"region": self._c.region,
+			"id": self._id
+		}
+
 	def commit (self):
 		delete_transc_tag(self._c, self._id, self._logger)
 
@@ -277,16 +1151,34 @@ class EC2AttachedVolumeHold (ResourceHold):
 			self,
 			c: BotoClientWrapper,
 			id: str,
-			transc_id: str,
-			logger: ResourceTransactionLogger):
+			transc_id: str | None,
+			logger: ResourceTransactionLogger,
+			instance_id: str | None = None):
+		'''The volume is tagged with `transc_id` and `instance_id` unless
+		`transc_id` is None'''
 		self._c = c
 		self._id = id
 		self._logger = logger
 
-		put_transc_tag(c, id, transc_id, logger)
+		if transc_id:
+			put_transc_tag(c, id, transc_id, logger, instance_id)
+
+	def state (self) -> dict[str, Any]:
+		return {
+			"type": "ec2-attached-volume",
+			"domain": self._c.domain,
+			"region": self._c.region,
+			"id": self._id
+		}
 
 	def commit (self):
 		delete_transc_tag(self._c, self._id, self._logger)
+		try:
+			put_ts_used_tag(self._c, [ self._id ], self._logger)
+		except Exception as e:
+			# the volume is in use already. Only the pool preference is off
+			# until the next stamp
+			pexcept(e, "Stamping " + self._id)
 
 	def rollback (self):
 		delete_transc_tag(self._c, self._id, self._logger)
@@ -297,8 +1189,11 @@ class EC2AttachedVolumeHold (ResourceHold):
 			VolumeId = self._id,
 			Force = True)
 
+		# Bounded so that a stuck detachment does not hold up the rollback of
+		# the rest. The volume is left for `clean_up_transc()`.
+		deadline = Deadline(Magic.Code.EC2_VOL_DETACH_TIMEOUT)
 		while rsp["State"] in [ "in-use", "detaching" ]:
-			time.sleep(Magic.Code.EC2_VOL_DETACH_WAIT)
+			deadline.sleep(Magic.Code.EC2_VOL_DETACH_WAIT)
 
 			rsp = self._c.do_call(
 				"describe_volumes",
@@ -310,11 +1205,301 @@ class EC2AttachedVolumeHold (ResourceHold):
 
 		return rsp
 
+def norm_r53_name (name: str) -> str:
+	'''
+	Route 53 returns the names in lower case with the trailing dot and the
+	wildcard escaped(`\\052`).
+	'''
+	return name.lower().rstrip('.').replace("\\052", '*')
+
 def mk_r53_rrchanges (
 		action: str,
 		rrs: Iterable[dict[str, Any]]) -> Iterable[dict[str, Any]]:
 	return [ { "Action": action, "ResourceRecordSet": rr } for rr in rrs ]
 
+class Route53ChangeBatcher:
+	'''Collects RR changes from all domains and applies them in one ChangeBatch
+	per hosted zone. A zone is flushed when all the expected submissions for
+	the zone have arrived or `linger` seconds after the first submission,
+	whichever comes first. It's also flushed when only the domains already
+	waiting in `submit()` have more to submit, as they can't submit more until
+	then.
+
+	Each submission is logged to its own domain's logger with only its own
+	changes so that the holds and the transaction logs stay per domain. So
+	are the retries of the ChangeBatch.'''
+
+	class _Submission:
+		def __init__ (
+				self,
+				c: BotoClientWrapper,
+				changes: list[dict[str, Any]],
+				logger: ResourceTransactionLogger):
+			self.c = c
+			self.changes = changes
+			self.logger = logger
+			self.fut = futures.Future()
+
+		def size (self) -> tuple[int, int, int]:
+			rrs = 0
+			chars = 0
+			for change in self.changes:
+				for rr in change["ResourceRecordSet"].get("ResourceRecords", []):
+					rrs += 1
+					chars += len(rr["Value"])
+
+			return ( len(self.changes), rrs, chars )
+
+		def keys (self) -> set[tuple[str, str]]:
+			return set([
+				( c["ResourceRecordSet"]["Name"], c["ResourceRecordSet"]["Type"] )
+				for c in self.changes ])
+
+	def __init__ (self, linger: float = Magic.Code.R53_BATCH_LINGER):
+		self._linger = linger
+		self._lock = threading.Lock()
+		# hz -> domain -> the submissions yet to be made
+		self._expected = dict[str, dict[str, int]]()
+		self._subs = dict[str, list[Route53ChangeBatcher._Submission]]()
+		self._timers = dict[str, threading.Timer]()
+
+	def _add_expected (self, hz: str, domain: str, n: int):
+		d = self._expected.setdefault(hz, dict[str, int]())
+		d[domain] = max(0, d.get(domain, 0) + n)
+
+	def expect (self, hz: str, domain: str, n: int = 1):
+		with self._lock:
+			self._add_expected(hz, domain, n)
+
+	def withdraw (self, hz: str, domain: str):
+		'''Called instead of `submit()` when a expected submission will never
+		be made'''
+		with self._lock:
+			self._add_expected(hz, domain, -1)
+			batch = self._pop_ready(hz)
+
+		self._apply(hz, batch)
+
+	def submit (
+			self,
+			c: BotoClientWrapper,
+			hz: str,
+			changes: list[dict[str, Any]],
+			logger: ResourceTransactionLogger) -> dict[str, Any]:
+		'''Returns the ChangeInfo of the ChangeBatch the changes were in'''
+		sub = Route53ChangeBatcher._Submission(c, changes, logger)
+
+		with self._lock:
+			self._subs.setdefault(hz, []).append(sub)
+			batch = self._pop_ready(hz)
+			if not batch and hz not in self._timers:
+				t = threading.Timer(self._linger, self._flush, [ hz ])
+				t.daemon = True
+				self._timers[hz] = t
+				t.start()
+
+		self._apply(hz, batch)
+
+		return sub.fut.result()
+
+	def _pop_ready (self, hz: str) -> list[_Submission]:
+		subs = self._subs.get(hz, [])
+		if not subs:
+			return []
+
+		left = dict(self._expected.get(hz, {}))
+		for sub in subs:
+			left[sub.c.domain] = left.get(sub.c.domain, 0) - 1
+		waiting = set(sub.c.domain for sub in subs)
+		if any(n > 0 and d not in waiting for d, n in left.items()):
+			return []
+		return self._pop(hz)
+
+	def _pop (self, hz: str) -> list[_Submission]:
+		ret = self._subs.pop(hz, [])
+		for sub in ret:
+			self._add_expected(hz, sub.c.domain, -1)
+		t = self._timers.pop(hz, None)
+		if t:
+			t.cancel()
+
+		return ret
+
+	def _flush (self, hz: str):
+		with self._lock:
+			batch = self._pop(hz)
+		self._apply(hz, batch)
+
+	def _chunk (self, batch: list[_Submission]) -> list[list[_Submission]]:
+		'''Split the submissions into chunks within the batch limits. Changes
+		for the same RR set go into different chunks as Route 53 rejects a
+		batch with more than one change for the same RR set.'''
+		ret = list[list[Route53ChangeBatcher._Submission]]()
+		cur = list[Route53ChangeBatcher._Submission]()
+		cur_size = [ 0, 0, 0 ]
+		cur_keys = set[tuple[str, str]]()
+		limits = [
+			Magic.Code.R53_BATCH_MAX_CHANGES,
+			Magic.Code.R53_BATCH_MAX_RRS,
+			Magic.Code.R53_BATCH_MAX_CHARS ]
+
+		for sub in batch:
+			size = sub.size()
+			keys = sub.keys()
+			fits = all([ a + b <= l for a, b, l in zip(cur_size, size, limits) ])
+			if cur and (not fits or cur_keys & keys):
+				ret.append(cur)
+				cur = []
+				cur_size = [ 0, 0, 0 ]
+				cur_keys = set()
+
+			cur.append(sub)
+			cur_size = [ a + b for a, b in zip(cur_size, size) ]
+			cur_keys |= keys
+
+		if cur:
+			ret.append(cur)
+
+		return ret
+
+	def _call (self, hz: str, chunk: list[_Submission]) -> dict[str, Any]:
+		changes = list[dict[str, Any]]()
+		for sub in chunk:
+			changes += sub.changes
+
+		def on_log (logs: Iterable[ResourceTransactionLog]):
+			# the call and its retries, with only the domain's own changes
+			for log in logs:
+				d = log.dict()
+				for sub in chunk:
+					if sub.logger:
+						sub.logger.publish([ AWSResourceTranscLog(
+							sub.c.domain,
+							"change_resource_record_sets",
+							{
+								"HostedZoneId": hz,
+								"ChangeBatch": { "Changes": sub.changes }
+							},
+							attempt = d["attempt"],
+							error = d["error"]) ])
+
+		logger = ResourceTransactionLogger(0)
+		logger.cbset.add(on_log)
+
+		return chunk[0].c.do_call(
+			"change_resource_record_sets",
+			logger,
+			HostedZoneId = hz,
+			ChangeBatch = { "Changes": changes })["ChangeInfo"]
+
+	def _apply (self, hz: str, batch: list[_Submission]):
+		for chunk in self._chunk(batch):
+			try:
+				rsp = self._call(hz, chunk)
+			except Exception as e:
+				if len(chunk) == 1:
+					chunk[0].fut.set_exception(e)
+					continue
+
+				# find out whose changes are at fault
+				for sub in chunk:
+					try:
+						sub.fut.set_result(self._call(hz, [ sub ]))
+					except Exception as e:
+						sub.fut.set_exception(e)
+			else:
+				for sub in chunk:
+					sub.fut.set_result(rsp)
+
+class Route53SyncWaiter:
+	'''Waits for the tracked Route 53 changes to become INSYNC in a background
+	thread. `on_synced` is called with the seconds elapsed since the first
+	change was tracked and the domains that made the changes once all of them
+	are INSYNC.
+
+	The wait is given up after `timeout` seconds or `max_errors` consecutive
+	errors. `on_error` is called with the reason in that case.'''
+
+	def __init__ (
+			self,
+			steps: Iterable[float] = Magic.Code.R53_INSYNC_POLLWAIT_STEPS,
+			timeout: float = Magic.Code.R53_INSYNC_TIMEOUT,
+			max_errors: int = Magic.Code.R53_INSYNC_MAX_ERRORS):
+		self.on_synced: Callable[[float, set[str]], Any] | None = None
+		self.on_error: Callable[[Exception], Any] | None = None
+		self.domains = set[str]()
+		self._steps = list[float](steps)
+		self._timeout = timeout
+		self._max_errors = max_errors
+		self._lock = threading.Lock()
+		self._pending = dict[str, BotoClientWrapper]()
+		self._started: float | None = None
+		self._th: threading.Thread | None = None
+
+	def __bool__ (self) -> bool:
+		return self._started is not None
+
+	def track (self, c: BotoClientWrapper, change_id: str):
+		with self._lock:
+			if self._started is None:
+				self._started = time.monotonic()
+			# the changes batched together share the id
+			self._pending.setdefault(change_id, c)
+			self.domains.add(c.domain)
+
+	def start (self):
+		if not self or self._th:
+			return
+
+		self._th = threading.Thread(
+			target = self._main,
+			name = "route53-sync-waiter",
+			daemon = True)
+		self._th.start()
+
+	def _give_up (self, e: Exception):
+		if self.on_error:
+			self.on_error(e)
+
+	def _main (self):
+		wait_steps = EC2VolumeCreatePollWaitStep(self._steps)
+		deadline = Deadline(self._timeout)
+		errors = 0
+
+		while True:
+			with self._lock:
+				pending = list(self._pending.items())
+			if not pending:
+				break
+
+			for change_id, c in pending:
+				try:
+					rsp = c.do_call("get_change", None, Id = change_id)
+				except Exception as e:
+					# try again next time, unless it keeps failing(permission)
+					errors += 1
+					if errors >= self._max_errors:
+						self._give_up(e)
+						return
+					continue
+				errors = 0
+
+				if rsp["ChangeInfo"]["Status"] == "INSYNC":
+					with self._lock:
+						del self._pending[change_id]
+
+			with self._lock:
+				if not self._pending:
+					break
+			try:
+				deadline.sleep(wait_steps.next())
+			except TimeoutError as e:
+				self._give_up(e)
+				return
+
+		if self.on_synced:
+			self.on_synced(time.monotonic() - self._started, self.domains)
+
 class Route53InsertedRRHold (ResourceHold):
 	def __init__ (
 			self,
@@ -327,6 +1512,15 @@ class Route53InsertedRRHold (ResourceHold):
 		self._rrs = rrs
 		self._logger = logger
 
+	def state (self) -> dict[str, Any]:
+		return {
+			"type": "route53-inserted-rr",
+			"domain": self._c.domain,
+			"region": self._c.region,
+			"hostedzone": self._hzi,
+			"rrs": self._rrs
+		}
+
 	def commit (self):
 		pass
 
@@ -349,6 +1543,15 @@ class Route53UpdatedRRHold (ResourceHold):
 		self._rrs = saved
 		self._logger = logger
 
+	def state (self) -> dict[str, Any]:
+		return {
+			"type": "route53-updated-rr",
+			"domain": self._c.domain,
+			"region": self._c.region,
+			"hostedzone": self._hzi,
+			"rrs": self._rrs
+		}
+
 	def commit (self):
 		pass
 
@@ -359,57 +1562,324 @@ class Route53UpdatedRRHold (ResourceHold):
 		}
 		return self._c.do_call("change_resource_record_sets", self._logger, **param)
 
-def _init_common_post_client_opts (opts: dict[str, Any]) -> dict[str, Any]:
-	kwargs = dict[str, Any]()
-	region = opts.get("region")
-	if region:
-		kwargs["region_name"] = region
+class AWSClientPool:
+	'''Process-wide boto3 clients keyed by (profile, region, service).
+
+	boto3 clients are thread-safe, but sessions are not, hence the lock. The
+	clients are shared across the init, notify and interruption phases so that
+	the service models are loaded once and the HTTP connections are reused.'''
+
+	def __init__ (
+			self,
+			profile: str | None = None,
+			max_pool_connections: int = Magic.Code.AWS_MAX_POOL_CONNECTIONS,
+			connect_timeout: float = Magic.Code.AWS_CONNECT_TIMEOUT,
+			read_timeout: float = Magic.Code.AWS_READ_TIMEOUT):
+		self.profile = profile
+		self.max_pool_connections = max_pool_connections
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self._lock = threading.Lock()
+		self._sessions = dict[str | None, Any]()
+		self._clients = dict[tuple[str | None, str | None, str], Any]()
+
+	def _session (self, profile: str | None):
+		ret = self._sessions.get(profile)
+		if ret is None:
+			kwargs = dict[str, Any]()
+			if profile:
+				kwargs["profile_name"] = profile
+			ret = _load_sdk()[0].session.Session(**kwargs)
+			self._sessions[profile] = ret
+
+		return ret
+
+	def default_region (self) -> str | None:
+		'''The region from the environment or the profile'''
+		with self._lock:
+			return self._session(self.profile).region_name
+
+	def client (self, service: str, region: str | None = None):
+		key = ( self.profile, region, service )
+
+		with self._lock:
+			ret = self._clients.get(key)
+			if ret is None:
+				ret = self._session(self.profile).client(
+					service,
+					region_name = region,
+					config = _load_sdk()[1].config.Config(
+						max_pool_connections = self.max_pool_connections,
+						connect_timeout = self.connect_timeout,
+						read_timeout = self.read_timeout,
+						# retried by `BotoClientWrapper`
+						retries = { "mode": "standard", "max_attempts": 1 }))
+				self._clients[key] = ret
+
+		return ret
 
-	return kwargs
+HOLD_TYPES = {
+	"ec2-created-volume": ( "ec2", EC2CreatedVolumeHold ),
+	"ec2-attached-volume": ( "ec2", EC2AttachedVolumeHold ),
+	"route53-inserted-rr": ( "route53", Route53InsertedRRHold ),
+	"route53-updated-rr": ( "route53", Route53UpdatedRRHold ),
+}
+
+def restore_hold (
+		pool: AWSClientPool,
+		state: dict[str, Any],
+		logger: ResourceTransactionLogger) -> ResourceHold:
+	'''Make the hold from `ResourceHold.state()` of another process'''
+	service, cls = HOLD_TYPES[state["type"]]
+	c = BotoClientWrapper(
+		pool.client(service, state.get("region")),
+		state.get("domain"))
+
+	if cls is EC2CreatedVolumeHold:
+		return cls(c, state["id"], logger)
+	if cls is EC2AttachedVolumeHold:
+		# tagged already
+		return cls(c, state["id"], None, logger)
+	return cls(c, state["hostedzone"], state["rrs"], logger)
 
 class SNSNotifyBackend (NotifyBackend):
-	def __init__ (self, session, opts: dict[str, Any]):
-		self._client = session.client(
-			"sns",
-			**_init_common_post_client_opts(opts))
+	'''One message per publish. `NotifyDispatcher` publishes concurrently on
+	the pooled client.'''
+	def __init__ (self, pool: AWSClientPool, opts: dict[str, Any]):
+		self._client = BotoClientWrapper(
+			pool.client("sns", opts.get("region")),
+			None)
 		self._topic = opts["topic"]
 
+	@override
+	def target (self) -> Any:
+		return ( "sns", self._client.region, self._topic )
+
 	def post (self, subject: str, body: str):
-		return self._client.publish(
+		return self._client.do_call(
+			"publish",
+			None,
 			TopicArn = self._topic,
 			Subject = subject,
 			Message = body)
 
 class SQSNotifyBackend (NotifyBackend):
-	def __init__ (self, session, opts: dict[str, Any]):
-		self._client = session.client(
-			"sqs",
-			**_init_common_post_client_opts(opts))
+	max_batch = Magic.Code.SQS_BATCH_MAX
+
+	def __init__ (self, pool: AWSClientPool, opts: dict[str, Any]):
+		self._client = BotoClientWrapper(
+			pool.client("sqs", opts.get("region")),
+			None)
 		self._q_url = opts["queue-url"]
 
+	@override
+	def target (self) -> Any:
+		return ( "sqs", self._client.region, self._q_url )
+
 	def post (self, subject: str, body: str):
-		return self._client.send_message(
+		return self._client.do_call(
+			"send_message",
+			None,
 			QueueUrl = self._q_url,
 			MessageBody = body)
 
-def clean_up_transc (
-		transc_id: str) -> tuple[Iterable[ResourceTransactionLog], Exception]:
-	# TODO
+	@override
+	def post_batch (
+			self,
+			msgs: list[tuple[str, str]]) -> list[Exception | None]:
+		ret = list[Exception | None]([ None ] * len(msgs))
+
+		# split further by the payload size limit
+		calls = list[list[int]]()
+		size = 0
+		for i, ( _, body ) in enumerate(msgs):
+			n = len(body.encode())
+			if not calls or size + n > Magic.Code.SQS_BATCH_MAX_BYTES:
+				calls.append([])
+				size = 0
+			calls[-1].append(i)
+			size += n
+
+		for l in calls:
+			try:
+				rsp = self._client.do_call(
+					"send_message_batch",
+					None,
+					QueueUrl = self._q_url,
+					Entries = [
+						{ "Id": str(i), "MessageBody": msgs[i][1] } for i in l
+					])
+			except Exception as e:
+				for i in l:
+					ret[i] = e
+				continue
+
+			for f in rsp.get("Failed", []):
+				ret[int(f["Id"])] = NotifyFailedError(
+					'''{code}: {msg}'''.format(
+						code = f.get("Code"),
+						msg = f.get("Message")),
+					not f.get("SenderFault"))
+
+		return ret
+
+def sweep_min_age (init_timeout: float | None) -> float | None:
+	'''
+	A transaction is abandoned for sure after the init timed out and failed to
+	roll back. None if the init has no timeout, in which case no transaction
+	is old enough.
 	'''
-	This function left unimplemented for the moment.
+	if init_timeout is None:
+		return None
+	return init_timeout + magic.Code.ROLLBACK_GRACE
 
-	The function is for cleaning up any resources `TransientResourceManager`
-	failed to clean up upon rollback.
+def _sweep_vol (
+		c: BotoClientWrapper,
+		vol: dict[str, Any],
+		logger: ResourceTransactionLogger):
+	vid = vol["VolumeId"]
+	created = get_tag(vol, Magic.TagName.IN_TRANSIT) == "true"
 
-	It should do following:
+	if vol["State"] in [ "in-use", "detaching" ]:
+		rsp = c.do_call(
+			"detach_volume",
+			logger,
+			VolumeId = vid,
+			Force = True)
 
-	- Get all resources with "user:ec2fd.in-transit"(`Magic.TagName.IN_TRANSIT`)
-	  flag set. For each resource ...
-	  - Detach/Disassociate if required
-	  - Delete the resource
+		if created:
+			# can't be deleted until it's detached
+			deadline = Deadline(Magic.Code.EC2_VOL_DETACH_TIMEOUT)
+			while rsp["State"] != "available":
+				deadline.sleep(Magic.Code.EC2_VOL_DETACH_WAIT)
+
+				rsp = c.do_call(
+					"describe_volumes",
+					logger,
+					VolumeIds = [ vid ])["Volumes"]
+				if not rsp: # GONE!
+					return
+				rsp = rsp[0]
+
+	if created:
+		c.do_call("delete_volume", logger, VolumeId = vid)
+	else:
+		# the detachment has to succeed first. Otherwise, the volume would be
+		# returned to the pool while it's still in use.
+		delete_transc_tag(c, vid, logger)
+
+def _is_stale_vol (vol: dict[str, Any], min_age: float) -> bool:
+	if min_age <= 0:
+		return True
+
+	if get_tag(vol, Magic.TagName.IN_TRANSIT) == "true":
+		since = vol["CreateTime"]
+	else:
+		since = None
+		for att in vol.get("Attachments", []):
+			t = att.get("AttachTime")
+			if t and (since is None or t > since):
+				since = t
+		if since is None:
+			claimed = get_tag(vol, Magic.TagName.TS_CLAIMED)
+			try:
+				since = datetime.datetime.fromisoformat(claimed)
+			except (TypeError, ValueError):
+				# nobody's using it
+				return True
+			if since.tzinfo is None:
+				since = since.replace(tzinfo = datetime.UTC)
+
+	now = datetime.datetime.now(datetime.UTC)
+	return (now - since).total_seconds() >= min_age
+
+def _is_claimed_elsewhere (vol: dict[str, Any]) -> bool:
+	'''Attached to an instance other than the one that claimed it. The claim
+	was lost to that instance and the tags are ours left behind.'''
+	claimed_by = get_tag(vol, Magic.TagName.CLAIMED_BY)
+	if not claimed_by:
+		return False
+
+	return any(
+		att.get("InstanceId") not in [ None, claimed_by ]
+		for att in vol.get("Attachments", []))
 
-	I didn't bother implementing it because the only time
-	`TransientResourceManager` fails to clean up after itself is when the init
-	process times out and the main process has to kill the init process/thread.
+def clean_up_transc (
+		pool: AWSClientPool,
+		region: str | None,
+		transc_id: str | None = None,
+		domain: str | None = None,
+		min_age: float = 0.0,
+		max_workers: int = Magic.Code.SWEEP_CONCURRENCY
+		) -> tuple[Iterable[ResourceTransactionLog], Exception]:
+	'''
+	Clean up the resources `TransientResourceManager` failed to clean up upon
+	rollback. The only time that happens is when the init process times out
+	or is killed in the middle of a transaction.
+
+	The volumes with the transaction id tag(`Magic.TagName.TRANSC_ID`) are
+	looked up. The volumes created in the transaction(with
+	`Magic.TagName.IN_TRANSIT`) are detached and deleted. The volumes borrowed
+	from the pool are detached and untagged so that they can be picked again.
+
+	With `transc_id`, only the resources of the transaction are cleaned up.
+	Without it, all the transactions of the `domain` are swept. Use `min_age`
+	in that case so that the transactions still in progress on other instances
+	are left alone. The volumes attached to an instance other than the one
+	that claimed them are never touched.
+
+	Returns the logs and the exception, which is an `ExceptionGroup` of the
+	resources that could not be cleaned up.
 	'''
-	return ( [], None )
+	logger = ResourceTransactionLogger()
+
+	if transc_id:
+		filters = [ {
+			"Name": "tag:" + Magic.TagName.TRANSC_ID,
+			"Values": [ transc_id ]
+		} ]
+	else:
+		filters = [ {
+			"Name": "tag-key",
+			"Values": [ Magic.TagName.TRANSC_ID ]
+		} ]
+	if domain:
+		filters.append({
+			"Name": "tag:" + Magic.TagName.DOMAIN,
+			"Values": [ domain ]
+		})
+
+	try:
+		c = pool.client("ec2", region)
+
+		vols = list[dict[str, Any]]()
+		for rsp in BotoClientWrapper(c, domain).do_paginate(
+				"describe_volumes",
+				logger,
+				Filters = filters,
+				MaxResults = Magic.Code.SWEEP_PAGE_SIZE):
+			vols += [
+				v for v in rsp["Volumes"]
+				if not _is_claimed_elsewhere(v) and _is_stale_vol(v, min_age)
+			]
+	except Exception as e:
+		return ( logger.logs, e )
+
+	errors = list[Exception]()
+	with futures.ThreadPoolExecutor(max_workers) as executor:
+		fs = dict[futures.Future, str]()
+		for vol in vols:
+			wc = BotoClientWrapper(c, get_tag(vol, Magic.TagName.DOMAIN))
+			fs[executor.submit(_sweep_vol, wc, vol, logger)] = vol["VolumeId"]
+
+		for f in futures.as_completed(fs):
+			e = f.exception()
+			if e:
+				e.add_note(fs[f])
+				errors.append(e)
+
+	if errors:
+		return (
+			logger.logs,
+			ExceptionGroup("failed to clean up some volumes", errors) )
+	return ( logger.logs, None )
@@ -1,17 +1,48 @@
 class Code:
-	DEVICE_WAIT = 0.01 # 10ms
-	INIT_TIMEOUT = 600 # 1 minute
+	DEVICE_WAIT = 0.01 # 10ms (fallback spin wait without uevent)
+	DEVICE_TIMEOUT = 120 # 2 minutes
+	UEVENT_RECHECK = 1.0 # in case a uevent is lost
+	UEVENT_RCVBUF = 1048576 # 1MiB
+	NETLINK_KOBJECT_UEVENT = 15
+	DIRECTIVE_CONCURRENCY = 4 # per domain
+	INIT_TIMEOUT = 600 # 10 minutes
+	ROLLBACK_GRACE = 60 # time given to the domains to roll back after timeout
 	POLL_INTERVAL = 1 # 1 second
+	POLL_MIN_INTERVAL = 0.25 # 250ms
+	POLL_RAMP = 3600 # reach POLL_MIN_INTERVAL in an hour of instance age
+	POLL_JITTER = 0.1 # +-10%
+	POLL_BACKOFF_MAX = 5 # 5 seconds
+	POLL_BACKOFF_STEPS = 16 # the errors counted in the backoff at most
+	POLL_FLOOR = 0.05 # 50ms
+	POLL_RTT_WEIGHT = 0.2 # EWMA weight of IMDS round trip samples
+	EXEC_CAPTURE_SIZE = 4096 # the last 4KiB of output
+	EXEC_DRAIN_TIMEOUT = 1.0 # in case the grandchildren hold the pipes
+	INTERRUPT_MARGIN = 5 # left for the OS to shut down before the interruption
+	RATE_MIN = 0.1 # throttled down to 10% of the rate at most
+	RATE_RECOVERY = 0.05 # 5% of the rate regained per success
+	STATE_DIR = "/var/lib/ec2fleetd"
+	JOURNAL_SYNC_INTERVAL = 0.1 # 100ms
+	TRANSC_LOG_CAP = 1000 # the logs kept in memory
+	NOTIFY_CONCURRENCY = 8 # within AWS_MAX_POOL_CONNECTIONS
+	NOTIFY_MAX_PENDING = 1000 # the messages held before dropping
+	NOTIFY_RETRY_MAX = 3
+	NOTIFY_RETRY_BASE = 0.5
+	NOTIFY_RETRY_CAP = 5.0
+	NOTIFY_FLUSH_TIMEOUT = 30 # waited for the notifications on exit
 
 class Notify:
 	class Matrix:
 		DEFAULT_ROW = { "enabled": True }
+		OFF_ROW = { "enabled": False }
 		DEFAULT_MATRIX = {
 			"failed": DEFAULT_ROW,
 			"started": DEFAULT_ROW,
 			"stopping": DEFAULT_ROW,
-			"interrupted": DEFAULT_ROW
+			"interrupted": DEFAULT_ROW,
+			"dns-synced": DEFAULT_ROW
 	}
+		# off unless listed in the matrix given
+		OPT_IN = set([ "dns-synced" ])
 	SUBJECT = '''Fleetd {domain} on {instance_id} state changed to [{daemon_state}]'''
 	BODY = '''{all_json}'''
 